@@ -1,4 +1,4 @@
-from shade import App
+from shade import main
 
 if __name__ == '__main__':
-    App().run()
+    main()
@@ -1,298 +1,16 @@
 #!/usr/bin/env python3
 
-import json
-import os
-from collections import defaultdict
 from functools import lru_cache
-from typing import Dict, List
 
 import pygame
 from graphalama.app import Screen, App
 from graphalama.buttons import CarouselSwitch, Button
 from graphalama.core import Widget
+from visibility import VisibiltyCalculator
 
-from maths import clamp, approx
-from physics import AABB, Pos
-
-
-class Tile:
-    solid: bool
-    transparent: bool
-    name: str
-    file_path: str
-    sprite_sheet: pygame.Surface
-    neighbours_patterns: list
-    tile_size: int
-
-    def __init__(self, path, tile_size=0, solid=True, transparent=False):
-        self.solid = solid
-        self.transparent = transparent
-        self.file_path = path
-        self.tile_size = tile_size
-        self.load(self.file_path)
-
-    def load(self, path):
-        print("Loading tile set", path)
-        self.sprite_sheet = pygame.image.load(path).convert()
-        self.sprite_sheet.set_colorkey((255, 0, 255))
-        self.name = os.path.basename(path)
-        self.neighbours_patterns = self.load_neighbourg_data(path + ".data")
-
-    def load_neighbourg_data(self, path):
-        return [
-            ["? ? ==?=?", "? ?======", "? ?== ?=?", "? ? = ?=?", "===?==?= ", "=====? =?"],
-            ["?=? ==?=?", "=========", "?=?== ?=?", "?=? = ?=?", "?= ?=====", " =?==?==="],
-            ["?=? ==? ?", "?=?===? ?", "?=?== ? ?", "?=? = ? ?", "? ? ==?= ", "? ?==  =?"],
-            ["? ? ==? ?", "? ?===? ?", "? ?== ? ?", "? ? = ? ?", "?=  ==? ?", " =?== ? ?"]
-        ]
-
-    def get_tile_from_sheet(self, pos):
-        pos = pos[0] * self.tile_size, pos[1] * self.tile_size
-        size = self.tile_size, self.tile_size
-        return  self.sprite_sheet.subsurface((pos, size))
-
-    def get_image(self, neighbours=()):
-        pos = (1, 1)
-
-        if neighbours:
-            tile_name = neighbours[0][0]
-            for Y, line in enumerate(self.neighbours_patterns):
-                for X, pattern in enumerate(line):
-                    match = True
-                    for x in range(3):
-                        for y in range(3):
-                            c = pattern[3 * y + x]
-                            if c == '=':
-                                if neighbours[x - 1][y - 1] != tile_name:
-                                    match = False
-                            elif c == ' ':
-                                if neighbours[x - 1][y - 1] == tile_name:
-                                    match = False
-                            elif c == '?':
-                                # any tile will do
-                                pass
-
-                    if match:
-                        pos = X, Y
-
-        img = self.get_tile_from_sheet(pos)
-        return pygame.transform.scale(img, (self.tile_size, self.tile_size))
-
-
-class TileMap:
-    tiles: Dict[tuple, int]
-    tile_objects: List[Tile]
-    tile_size: int
-
-    def __init__(self, tile_objects=None, tiles=None, tile_size=16):
-        self.scale = 4
-        self.render_topleft = (0, 0)
-        self.tile_size = tile_size
-        self.tiles = tiles if tiles is not None else {}
-        self.tile_objects = tile_objects if tile_objects is not None else []
-
-    def world_pos_to_map(self, world_pos):
-        return (world_pos[0] // self.tile_size, world_pos[1] // self.tile_size)
-
-    def map_to_world_pos(self, map_pos):
-        return (map_pos[0] * self.tile_size, map_pos[1] * self.tile_size)
-
-    def tile_at_map_pos(self, map_pos):
-        if map_pos in self.tiles:
-            tile_id = self.tiles[map_pos]
-            return self.tile_objects[tile_id]
-
-        return None
-
-    def tile_at_world_pos(self, world_pos):
-        world_pos = self.world_pos_to_map(world_pos)
-        return self.tile_at_map_pos(world_pos)
-
-    def map_to_display_pos(self, map_pos):
-        return Pos(self.map_to_world_pos(map_pos)) * self.scale + self.render_topleft
-
-    def display_to_map_pos(self, display_pos):
-        return self.world_pos_to_map((Pos(display_pos) - self.render_topleft) // self.scale)
-
-
-    def save(self, file='assets/levels/0'):
-        tile_paths = [tile.file_path for tile in self.tile_objects]
-
-        tile_map = {}
-        for pos, tile_id in self.tiles.items():
-            tile_map[f'{pos[0]} {pos[1]}'] = tile_id
-
-        to_save = dict(tile_paths=tile_paths,
-                       tile_map=tile_map,
-                       tile_size=self.tile_size)
-        s = json.dumps(to_save)
-        with open(file, 'w') as f:
-            f.write(s)
-
-    @classmethod
-    def load(cls, file='assets/levels/0'):
-        with open(file, 'r') as f:
-            d = json.loads(f.read())
-
-        tile_ids = d.pop('tile_map')
-        tile_paths = d.pop('tile_paths')
-        tile_size = d.pop('tile_size')
-
-        tiles = [Tile(path, tile_size) for path in tile_paths]
-
-        map_ = {}
-        for pos_string, tile in tile_ids.items():
-            x, y = map(int, pos_string.split())
-            map_[(x, y)] = tile
-
-        map_ = cls(tiles, map_, tile_size)
-
-        return map_
-
-    def get_neighbours_name(self, map_pos):
-        """Get a table with the neighbors. topleft will be table[-1][-1] and center right will be table[1][0]."""
-        neigh = [[None] * 3 for _ in range(3)]
-
-        for x in range(-1, 2):
-            for y in range(-1, 2):
-                neighbor = map_pos[0] + x, map_pos[1] + y
-                tile = self.tile_at_map_pos(neighbor)
-                if tile is not None:
-                    tile = tile.name
-                neigh[x][y] = tile
-
-        return tuple(tuple(line) for line in neigh)
-
-    @lru_cache(maxsize=None)
-    def get_image_at(self, map_pos, scale):
-        tile = self.tile_at_map_pos(map_pos)
-        image = tile.get_image(self.get_neighbours_name(map_pos))
-        return pygame.transform.scale(image, (scale * self.tile_size, scale * self.tile_size))
-
-    def collision_rects(self):
-        # we sort them by Y then X
-        positions = [(pos[1], pos[0]) for pos in self.tiles]
-        positions.sort()
-
-        # assuming a constant tile size
-        tile_size = self.tile_size
-
-        # so we can have line rects easily
-        line_rects = []
-        first = positions[0]
-        last = positions[0]
-        for pos in positions[1:]:
-            if pos[0] == last[0] and pos[1] == last[1] + 1:
-                # just after on the same line : we expand the block
-                last = pos
-            else:
-                # end of last block
-                size = last[1] - first[1] + 1
-                x = first[1] * tile_size
-                y = first[0] * tile_size
-                w = size * tile_size
-                h = tile_size
-                line_rects.append(AABB(x, y, w, h))
-
-                # we start a new block
-                first = pos
-                last = pos
-
-        # we add the last block too
-        size = last[1] - first[1] + 1
-        x = first[1] * tile_size
-        y = first[0] * tile_size
-        w = size * tile_size
-        h = tile_size
-        line_rects.append(AABB(x, y, w, h))
-
-        # todo: merge lines with the same width
-        return line_rects
-
-    def light_blockers(self):
-        segments = set()
-        for pos in self.tiles:
-            tile = self.tile_at_map_pos(pos)
-            if tile.transparent:
-                continue
-            x, y = pos
-            segs = [
-                ((x, y), (x + 1, y)),
-                ((x, y + 1), (x + 1, y + 1)),
-                ((x, y), (x, y + 1)),
-                ((x + 1, y), (x + 1, y + 1)),
-            ]
-
-            for seg in segs:
-                if seg in segments:
-                    # If it's already there, it's an edge between to blocks -> not visible
-                    segments.remove(seg)
-                else:
-                    segments.add(seg)
-
-        # At this point we have a set of unique edges that are between transparent and visible blocks
-        # we want to combine edges that are aligned to have less of them
-
-        # we class them by start position
-        start_dict = defaultdict(list)
-        for s in sorted(segments):
-            start_dict[s[0]].append(s)
-
-        def same_orientation(s1, s2):
-            # check collinearity
-            (ax, ay), (bx, by) = s1
-            (cx, cy), (dx, dy) = s2
-            ab = bx - ax, by - ay
-            cd = dx - cx, dy - cy
-            return ab[0] * cd[1] - ab[1] * cd[0] == 0
-
-        final = []
-        # reverse to avoid poping from left
-        segments = sorted(segments, reverse=True)
-        s = segments.pop()
-        # we merge all segments that have the same end but only when there's only only two that share to avoid crosses
-        while segments:
-            # only one that share end
-            if len(start_dict[s[1]]) == 1:
-                other = start_dict[s[1]][0]
-                if same_orientation(s, other):
-                    s = s[0], other[1]
-                    segments.remove(other)
-                else:
-                    final.append(s)
-                    s = segments.pop()
-            else:
-                final.append(s)
-                s = segments.pop()
-        final.append(s)
-
-        # scale everything right
-        p = self.tile_size
-        final = [((s[0][0] * p, s[0][1] * p), (s[1][0] * p, s[1][1] * p)) for s in final]
-
-        return final
-
-    def add_new_tile_type(self, path, *args, **kwargs):
-        tile = Tile(path, *args, **kwargs)
-        tile.tile_size = self.tile_size
-        self.tile_objects.append(tile)
-
-    def add_tile(self, pos, tile_id):
-        self.get_image_at.cache_clear()
-        self.tiles[pos] = tile_id
-
-    def remove_tile(self, pos):
-        self.get_image_at.cache_clear()
-        self.tiles.pop(pos, None)
-
-    def render(self, surf, scale=1, offset=(0, 0)):
-        for pos, tile_id in self.tiles.items():
-            tile = self.tile_objects[tile_id]
-            if tile.transparent:
-                continue
-            img = self.get_image_at(pos, scale)
-            topleft = Pos(self.map_to_world_pos(pos)) * scale + offset + self.render_topleft
-            surf.blit(img, topleft)
+from light import GlobalLightMask, Light
+from maths import clamp, approx, segments
+from tilemap import TileMap
 
 
 EDIT = 1
@@ -302,6 +20,9 @@ class EditScreen(Screen):
     BRUSH = 1
     ERASER = 2
 
+    TEST_LIGHT_COLORS = [(255, 200, 120), (120, 180, 255), (200, 255, 150)]
+    TEST_LIGHT_RANGE = 80
+
     def __init__(self, app):
         self.menu_width = 240
         # widgets
@@ -311,7 +32,8 @@ class EditScreen(Screen):
         reset = Button("Reset", self.reset, bg_color=(240, 100, 60))
         save = Button("Save", self.save)
         widgets = (self.widget_bg, self.tool_carousel, reset, save)
-        super().__init__(app, widgets, (20, 40, 90))
+        self.bg_color = (20, 40, 90)
+        super().__init__(app, widgets, self.bg_color)
 
         # map
         self.tile_size = 16
@@ -324,6 +46,21 @@ class EditScreen(Screen):
         self.map.render_topleft = self.menu_width, 0
         self._tile_index = 0
 
+        # Rendering: the zoomed map is kept on map_cache, and we only redraw
+        # on the display the cells that changed and the cursor
+        self.map_cache = None  # type: pygame.Surface
+        self.dirty_cells = set()
+        self.cursor_rect = None  # type: pygame.Rect
+        self.widgets_dirty = True
+        self.light_dirty = []
+
+        # Lighting preview, [l] to toggle
+        self.show_lighting = False
+        self.lighting = None  # type: GlobalLightMask
+        self.light_overlay = None  # type: pygame.Surface
+        self.blockers = set()
+        self.test_lights = []
+
         # editor settings
         self.scale = 4
         self.drawing = False
@@ -337,6 +74,8 @@ class EditScreen(Screen):
     def scale(self, value):
         self._scale = clamp(value, 1, 10)
         self.map.scale = self._scale
+        # the whole map needs to be drawn again with the new zoom
+        self.map_cache = None
 
     @property
     def tile_index(self):
@@ -355,9 +94,16 @@ class EditScreen(Screen):
 
     def update(self, event):
         if super(EditScreen, self).update(event):
+            self.widgets_dirty = True
             return
 
-        if event.type == pygame.MOUSEBUTTONDOWN:
+        if event.type == pygame.MOUSEMOTION:
+            # widgets may change on hover
+            if event.pos[0] < self.menu_width:
+                self.widgets_dirty = True
+        elif event.type == pygame.VIDEORESIZE:
+            self.map_cache = None
+        elif event.type == pygame.MOUSEBUTTONDOWN:
             self.drawing = True
         elif event.type == pygame.MOUSEBUTTONUP:
             self.drawing = False
@@ -370,40 +116,197 @@ class EditScreen(Screen):
                 self.save()
             elif event.key == pygame.K_b:
                 self.tool_carousel.option_index = self.tool_carousel.options.index("Brush")
+                self.widgets_dirty = True
             elif event.key == pygame.K_e:
                 self.tool_carousel.option_index = self.tool_carousel.options.index("Eraser")
+                self.widgets_dirty = True
             elif event.key == pygame.K_MINUS:
-                self.scale = min(self.scale - 1, 1)
+                self.scale -= 1
             elif event.key == pygame.K_PLUS:
                 self.scale += 1
+            elif event.key == pygame.K_l:
+                self.toggle_lighting()
+            elif event.key == pygame.K_k:
+                self.add_test_light(pygame.mouse.get_pos())
 
     def internal_logic(self):
         if self.drawing:
             pos = pygame.mouse.get_pos()
             pos = self.map.display_to_map_pos(pos)
 
-            if self.tool == self.BRUSH:
-                self.map.add_tile(pos, self.tile_index)
-            elif self.tool == self.ERASER:
-                self.map.remove_tile(pos)
+            if self.tool == self.BRUSH and self.map.tiles.get(pos) != self.tile_index:
+                changes = self.map.add_tile(pos, self.tile_index)
+            elif self.tool == self.ERASER and pos in self.map.tiles:
+                changes = self.map.remove_tile(pos)
+            else:
+                return
 
-    def render(self, display):
-        self.draw_background(display)
+            # the neighbours may change their image too
+            self.dirty_cells.update((pos[0] + dx, pos[1] + dy) for dx in range(-1, 2) for dy in range(-1, 2))
 
-        self.map.render(display, self.scale)
+            if self.lighting and changes:
+                self.relight(pos, *changes)
 
-        # cursor
-        img = self.current_tile.get_image()
-        img = pygame.transform.scale(img, (self.tile_size * self.scale, ) *2)
+    @property
+    def map_area(self):
+        """Part of the display where the map is visible."""
+        w, h = self.map_cache.get_size()
+        return pygame.Rect(self.menu_width, 0, w - self.menu_width, h)
+
+    def cell_rect(self, map_pos):
+        """Rect of a cell on the display."""
+        size = self.tile_size * self.scale
+        return pygame.Rect(approx(self.map.map_to_display_pos(map_pos)), (size, size))
+
+    @lru_cache()
+    def cursor_image(self, tile_index, scale):
+        img = self.map.tile_objects[tile_index].get_image()
+        img = pygame.transform.scale(img, (self.tile_size * scale, ) * 2)
         img.set_alpha(128)
-        pos = self.map.map_to_display_pos(self.map.display_to_map_pos(pygame.mouse.get_pos()))
-        print(pos)
-        display.blit(img, approx(pos))
+        return img
+
+    def rebuild_cache(self, size):
+        self.map_cache = pygame.Surface(size)
+        self.map_cache.fill(self.bg_color)
+        self.map.render(self.map_cache, self.scale)
+        self.dirty_cells.clear()
+        self.cursor_rect = None
+        if self.show_lighting:
+            # the visible part of the world changed, so the lights need everything again
+            self.create_lighting()
+        else:
+            self.lighting = None
+
+    # Lighting preview
 
-        self.widgets.render(display)
+    @property
+    def world_size(self):
+        """Size of the visible part of the map, in world coordinates."""
+        area = self.map_area
+        return area.w // self.scale, area.h // self.scale
+
+    def shadow_walls(self):
+        w, h = self.world_size
+        bound = pygame.Rect(-5, -5, w + 10, h + 10)
+        walls = list(self.blockers)
+        walls.extend(segments((bound.topleft, bound.topright,
+                               bound.bottomright, bound.bottomleft)))
+        return walls
+
+    def toggle_lighting(self):
+        self.show_lighting = not self.show_lighting
+        self.map_cache = None
+
+    def create_lighting(self):
+        w, h = self.world_size
+        if not self.test_lights:
+            self.test_lights = [Light((w * (i + 1) // 4, h // 3), color, self.TEST_LIGHT_RANGE)
+                                for i, color in enumerate(self.TEST_LIGHT_COLORS)]
+
+        self.blockers = set(self.map.light_blockers())
+        caster = VisibiltyCalculator(self.shadow_walls())
+        self.lighting = GlobalLightMask(self.test_lights, (w, h), caster, (30, 30, 30))
+        self.lighting.update_mask()
+        self.update_light_overlay()
+
+    def update_light_overlay(self, lights=()):
+        """Scale the light mask to the display and mark the area of the lights as dirty."""
+        area = self.map_area
+        w, h = self.world_size
+        self.light_overlay = pygame.transform.scale(self.lighting.surf_mask, (w * self.scale, h * self.scale))
+
+        for light in lights:
+            # the blur spreads the light a little further
+            rect = pygame.Rect(light.topleft, light.size).inflate(2 * self.lighting.blur, 2 * self.lighting.blur)
+            rect = pygame.Rect(rect.x * self.scale + area.x, rect.y * self.scale + area.y,
+                               rect.w * self.scale, rect.h * self.scale)
+            self.light_dirty.append(rect)
+
+    def relight(self, map_pos, added, removed):
+        """Update the lighting after the tile at map_pos changed and the light blockers with it."""
+
+        self.blockers.difference_update(removed)
+        self.blockers.update(added)
+        # visibility has no way to change only some walls, but building it is cheap,
+        # what costs is the masks of the lights, so we recompute only the ones that can see the tile
+        self.lighting.shadow_caster = VisibiltyCalculator(self.shadow_walls())
+
+        cell = pygame.Rect(self.map.map_to_world_pos(map_pos), (self.tile_size, self.tile_size))
+        lights = [light for light in self.lighting.lights
+                  if cell.colliderect(pygame.Rect(light.topleft, light.size))]
+        if lights:
+            self.lighting.update_mask(lights)
+            self.update_light_overlay(lights)
+
+    def add_test_light(self, display_pos):
+        if not self.lighting or not self.map_area.collidepoint(display_pos):
+            return
+
+        area = self.map_area
+        center = (display_pos[0] - area.x) // self.scale, (display_pos[1] - area.y) // self.scale
+        color = self.TEST_LIGHT_COLORS[len(self.test_lights) % len(self.TEST_LIGHT_COLORS)]
+        light = Light(center, color, self.TEST_LIGHT_RANGE)
+        self.test_lights.append(light)
+        self.lighting.update_mask([light])
+        self.update_light_overlay([light])
+
+    def restore(self, display, rect):
+        """Draw the map (lit if needed) on the display, only in rect."""
+        display.blit(self.map_cache, rect, rect)
+        if self.lighting:
+            area = self.map_area
+            display.blit(self.light_overlay, rect, rect.move(-area.x, -area.y), pygame.BLEND_RGB_MULT)
+
+    def render_cell(self, map_pos):
+        """Draw again a cell on the map cache and return its rect."""
+        rect = self.cell_rect(map_pos)
+        self.map_cache.fill(self.bg_color, rect)
+        tile = self.map.tile_at_map_pos(map_pos)
+        if tile is not None and not tile.transparent:
+            self.map_cache.blit(self.map.get_image_at(map_pos, self.scale), rect)
+        return rect
+
+    def render(self, display):
+        dirty = []
+        if self.map_cache is None or self.map_cache.get_size() != display.get_size():
+            self.rebuild_cache(display.get_size())
+            self.light_dirty = [self.map_area]
+            self.widgets_dirty = True
+
+        # put back what was under the cursor, the cells and the lights that changed
+        map_area = self.map_area
+        rects = [self.render_cell(pos) for pos in self.dirty_cells]
+        rects.extend(self.light_dirty)
+        self.dirty_cells.clear()
+        self.light_dirty = []
+        if self.cursor_rect:
+            rects.append(self.cursor_rect)
+        for rect in rects:
+            rect = rect.clip(map_area)
+            self.restore(display, rect)
+            dirty.append(rect)
+
+        # cursor
+        mouse = pygame.mouse.get_pos()
+        if map_area.collidepoint(mouse):
+            self.cursor_rect = self.cell_rect(self.map.display_to_map_pos(mouse))
+            display.set_clip(map_area)
+            display.blit(self.cursor_image(self.tile_index, self.scale), self.cursor_rect)
+            display.set_clip(None)
+            dirty.append(self.cursor_rect.clip(map_area))
+        else:
+            self.cursor_rect = None
+
+        if self.widgets_dirty:
+            self.widgets.render(display)
+            dirty.append(pygame.Rect(0, 0, self.menu_width, display.get_height()))
+            self.widgets_dirty = False
+
+        pygame.display.update(dirty)
 
     def reset(self):
-        self.map.tiles.clear()
+        self.map.clear()
+        self.map_cache = None
 
     def save(self):
         self.map.save()
@@ -0,0 +1,128 @@
+"""
+Images shared by everything that draws, decoded once per process.
+
+    from assets import assets
+
+    sheet = assets.acquire("assets/dirt_sheet.png", scale=4, colorkey=(255, 0, 255))
+    ...
+    assets.release("assets/dirt_sheet.png", scale=4, colorkey=(255, 0, 255))
+
+Each version of an image (scaled, flipped) is kept with the number of users that acquired it.
+Released images stay in the cache, so loading the same level again is instant,
+until evict() removes the ones that nobody uses anymore.
+The files can also be decoded in advance in a background thread with preload().
+"""
+
+import threading
+from collections import defaultdict
+
+import pygame
+
+
+class AssetCache:
+    def __init__(self):
+        # (path, scale, flip, colorkey, alpha) -> surface, ready to blit
+        self.images = {}  # type: dict[tuple, pygame.Surface]
+        self.refs = defaultdict(int)  # same keys -> number of users
+        # files decoded by the preloader, converted at the first acquire
+        self.decoded = {}  # type: dict[str, pygame.Surface]
+        self.lock = threading.Lock()
+        self.loads = 0  # number of files decoded, to check that the cache works
+
+    def acquire(self, path, scale=1, flip=False, colorkey=None, alpha=False):
+        """
+        The image at path, scaled and flipped horizontally if asked.
+        Call release with the same arguments when it is not used anymore.
+
+        :param colorkey: color that is transparent
+        :param alpha: keep the alpha channel of the file
+        """
+
+        key = (path, scale, flip, colorkey, alpha)
+        image = self.get(*key)
+        self.refs[key] += 1
+        return image
+
+    def release(self, path, scale=1, flip=False, colorkey=None, alpha=False):
+        key = (path, scale, flip, colorkey, alpha)
+        if self.refs[key] <= 0:
+            raise ValueError(f"{key} was released more than acquired")
+        self.refs[key] -= 1
+
+    def get(self, path, scale=1, flip=False, colorkey=None, alpha=False):
+        """Same as acquire, but without counting a user, so it can be evicted at any time."""
+
+        key = (path, scale, flip, colorkey, alpha)
+        image = self.images.get(key)
+        if image is not None:
+            return image
+
+        if scale != 1 or flip:
+            # from the original, which is cached too
+            image = self.get(path, 1, False, colorkey, alpha)
+            if flip:
+                image = pygame.transform.flip(image, True, False)
+            if scale != 1:
+                w, h = image.get_size()
+                image = pygame.transform.scale(image, (w * scale, h * scale))
+        else:
+            image = self._load(path)
+            image = image.convert_alpha() if alpha else image.convert()
+            if colorkey is not None:
+                image.set_colorkey(colorkey)
+
+        self.images[key] = image
+        return image
+
+    def _load(self, path):
+        with self.lock:
+            image = self.decoded.pop(path, None)
+        if image is None:
+            image = pygame.image.load(path)
+            self.loads += 1
+        return image
+
+    def evict(self, path=None):
+        """
+        Forget the images that nobody uses, only the versions of path if given.
+
+        :return: the number of images evicted
+        """
+
+        unused = [key for key in self.images
+                  if self.refs[key] == 0 and (path is None or key[0] == path)]
+        for key in unused:
+            del self.images[key]
+            del self.refs[key]
+        with self.lock:
+            if path is None:
+                self.decoded.clear()
+            else:
+                self.decoded.pop(path, None)
+        return len(unused)
+
+    def preload(self, paths):
+        """
+        Decode the files in a background thread, so they are ready when first acquired.
+        They still need a conversion, done by acquire in the main thread.
+
+        :return: the thread, already started
+        """
+
+        def load_all():
+            for path in paths:
+                with self.lock:
+                    if path in self.decoded or any(key[0] == path for key in list(self.images)):
+                        continue
+                image = pygame.image.load(path)
+                with self.lock:
+                    self.decoded[path] = image
+                    self.loads += 1
+
+        thread = threading.Thread(target=load_all, name="asset preloader", daemon=True)
+        thread.start()
+        return thread
+
+
+# The one used by the game
+assets = AssetCache()
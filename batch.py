@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Run many headless rollouts of the player in a level, on all the cores.
+
+A rollout is the player starting somewhere in the level with a script of inputs,
+one per tick, made of the PlayerPhysics.LEFT, RIGHT and JUMP bits.
+Its trajectory is a float32 array with the x, y of the topleft of the player
+and 1 when it stands on something, for each tick.
+
+This is useful to check levels automatically, for instance to see which
+platforms can be reached with given jump constants:
+
+    python batch.py --rollouts 5000 --ticks 300 --constant JUMP_IMPULSE=-4
+"""
+
+import argparse
+import ast
+from multiprocessing import Pool
+from time import perf_counter
+
+import numpy as np
+
+import player
+from bench import read_level, LEVEL
+from physics import Space, TileGrid
+from player import PlayerPhysics
+
+GRAVITY = (0, 0.2)
+
+# The level of each worker, loaded once
+_tiles = None
+_tile_size = None
+
+
+def _init_worker(file, constants):
+    global _tiles, _tile_size
+    _tiles, _, _tile_size = read_level(file)
+    for name, value in constants.items():
+        if not hasattr(player, name):
+            raise ValueError(f"player.py has no constant {name}")
+        setattr(player, name, value)
+
+
+def rollout(script, start=(42, 8)):
+    """
+    Simulate the player with the inputs of the script, in the level of the worker.
+
+    :param script: array of inputs, one per tick
+    :return: the trajectory, a float32 array of shape (len(script), 3)
+    """
+
+    space = Space(GRAVITY)
+    space.add(TileGrid(_tiles, _tile_size))
+    physics = PlayerPhysics(start)
+    space.add(physics.body)
+    shape = physics.body.shape
+
+    trajectory = np.empty((len(script), 3), dtype=np.float32)
+    for tick, held in enumerate(script.tolist()):
+        physics.set_input(held)
+        space.simulate()
+        physics.update_movement()
+        trajectory[tick] = shape.left, shape.top, physics.body.collide_down
+
+    return trajectory
+
+
+def _rollout(args):
+    return rollout(*args)
+
+
+def run_batch(scripts, start=(42, 8), file=LEVEL, constants=None, processes=None, chunksize=64):
+    """
+    Run a rollout for each script on a pool of processes.
+
+    :param scripts: array of shape (rollouts, ticks), or a list of scripts
+    :param constants: values for the constants of player.py, like {'JUMP_IMPULSE': -4}
+    :param processes: number of workers, all the cores by default
+    :return: array of shape (rollouts, ticks, 3) if all the scripts have the same length,
+        otherwise a list of trajectories
+    """
+
+    constants = constants or {}
+    with Pool(processes, _init_worker, (file, constants)) as pool:
+        trajectories = pool.map(_rollout, [(np.asarray(script), start) for script in scripts], chunksize)
+
+    if len({len(t) for t in trajectories}) == 1:
+        return np.stack(trajectories)
+    return trajectories
+
+
+def random_scripts(rollouts, ticks, hold=20, seed=0):
+    """Random inputs, each held for `hold` ticks on average."""
+
+    rng = np.random.default_rng(seed)
+    changes = rng.random((rollouts, ticks)) < 1 / hold
+    choices = rng.integers(0, 8, (rollouts, ticks), dtype=np.uint8)
+    # keep the last chosen input until the next change
+    last_change = np.maximum.accumulate(np.where(changes, np.arange(ticks), 0), axis=1)
+    return np.take_along_axis(choices, last_change, axis=1)
+
+
+def reached_tiles(trajectories, tile_size=16):
+    """The map positions of the tiles the player stood on."""
+
+    grounded = trajectories[..., 2] > 0
+    # the tile below the middle of the feet of the player
+    x = (trajectories[..., 0][grounded] + 8) // tile_size
+    y = (trajectories[..., 1][grounded] + 26) // tile_size
+    return set(zip(x.astype(int).tolist(), y.astype(int).tolist()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many player rollouts with random inputs.")
+    parser.add_argument("-r", "--rollouts", type=int, default=1000)
+    parser.add_argument("-t", "--ticks", type=int, default=300)
+    parser.add_argument("-p", "--processes", type=int, help="number of workers (default: all the cores)")
+    parser.add_argument("--level", default=LEVEL)
+    parser.add_argument("--constant", action="append", default=[], metavar="NAME=VALUE",
+                        help="change a constant of player.py, e.g. JUMP_IMPULSE=-4")
+    args = parser.parse_args()
+
+    constants = {}
+    for constant in args.constant:
+        name, value = constant.split("=", 1)
+        # numbers, tuples... like in player.py
+        constants[name] = ast.literal_eval(value)
+
+    scripts = random_scripts(args.rollouts, args.ticks)
+
+    start = perf_counter()
+    trajectories = run_batch(scripts, file=args.level, constants=constants, processes=args.processes)
+    duration = perf_counter() - start
+
+    print(f"{args.rollouts} rollouts of {args.ticks} ticks in {duration:.2f}s "
+          f"({args.rollouts * args.ticks / duration:.0f} ticks/s)")
+    print(f"The player stood on {len(reached_tiles(trajectories))} different tiles.")
+
+
+if __name__ == '__main__':
+    main()
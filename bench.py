@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the physics.
+
+Each scenario builds a Space, steps it for a number of ticks and reports
+the ticks per second, the cost per body and the allocations.
+Results can be saved as JSON to compare them between commits:
+
+    python bench.py --output before.json
+    ... change things ...
+    python bench.py --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import tracemalloc
+from time import perf_counter
+
+import level
+from physics import Space, Body, AABB, TileGrid
+from tilemap import TileMap, Tile
+
+GRAVITY = (0, 0.2)
+LEVEL = 'assets/levels/0'
+
+
+def read_level(file=LEVEL):
+    """Return the tiles, tile paths and the tile size of a level, without loading any image."""
+
+    if level.is_binary_level(file):
+        header, grid = level.read_grid(file)
+        return level.grid_to_tiles(grid, header.origin), header.tile_paths, header.tile_size
+
+    return level.read_json_level(file)
+
+
+def add_bodies(space, bodies, area, size=(16, 26), can_sleep=False, seed=0):
+    """Add bodies at random places in area (x, y, w, h) where they don't collide with anything."""
+
+    rng = random.Random(seed)
+    x, y, w, h = area
+    while len(space.moving_bodies) < bodies:
+        shape = AABB((rng.uniform(x, x + w - size[0]), rng.uniform(y, y + h - size[1])), size)
+        if any(collider.query(shape) for collider in space.colliders):
+            continue
+        body = Body(shape, elasticity=rng.choice((0, 0.5)), max_velocity=(3, 6), moving=True, can_sleep=can_sleep)
+        body.velocity.set(rng.uniform(-3, 3), rng.uniform(-3, 0))
+        space.add(body)
+
+    return space
+
+
+def synthetic_space(bodies=20, statics=100, size=(480, 270), can_sleep=False, seed=0):
+    """A space of the given size, with random static platforms and moving bodies."""
+
+    space = Space(GRAVITY)
+    rng = random.Random(seed)
+    w, h = size
+
+    # a floor and walls so bodies stay in the area
+    space.add(AABB(-16, h, w + 32, 16), AABB(-16, 0, 16, h), AABB(w, 0, 16, h))
+    for _ in range(statics - 3):
+        space.add(AABB(rng.randrange(0, w, 16), rng.randrange(0, h, 16), 16 * rng.randint(1, 4), 16))
+
+    return add_bodies(space, bodies, (0, 0, w, h), can_sleep=can_sleep, seed=seed)
+
+
+def level_space(bodies=20, file=LEVEL, collider='grid', can_sleep=False, seed=0):
+    """
+    A space with the tiles of a level and some bodies falling and bouncing on them.
+
+    :param collider: 'grid' to collide with a TileGrid, 'aabb' to use the AABBs of TileMap.collision_rects
+    """
+
+    tiles, tile_paths, tile_size = read_level(file)
+    space = Space(GRAVITY)
+
+    if collider == 'grid':
+        space.add(TileGrid(tiles, tile_size))
+    elif collider == 'aabb':
+        tile_map = TileMap([Tile(path, tile_size) for path in tile_paths], tiles, tile_size)
+        space.add(*tile_map.collision_rects())
+    else:
+        raise ValueError(f"Unknown collider {collider}")
+
+    xs = [x for x, y in tiles]
+    ys = [y for x, y in tiles]
+    area = (min(xs) * tile_size, min(ys) * tile_size,
+            (max(xs) - min(xs)) * tile_size, (max(ys) - min(ys)) * tile_size)
+    return add_bodies(space, bodies, area, can_sleep=can_sleep, seed=seed)
+
+
+def measure_allocations(space, ticks=1000):
+    """
+    Step the space and measure its allocations with tracemalloc.
+
+    :return: (peak, kept) in bytes per tick. The peak is the most memory
+        that was allocated at once by a tick, kept is what stays after all ticks.
+    """
+
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    peak = 0
+    for _ in range(ticks):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        space.simulate()
+        _, tick_peak = tracemalloc.get_traced_memory()
+        peak = max(peak, tick_peak - before)
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak, (end - start) / ticks
+
+
+def measure_speed(space, ticks=1000):
+    """Return the number of ticks per second."""
+    start = perf_counter()
+    for _ in range(ticks):
+        space.simulate()
+    return ticks / (perf_counter() - start)
+
+
+def run_scenario(name, space, ticks, warmup=100):
+    for _ in range(warmup):
+        space.simulate()
+
+    bodies = len(space.moving_bodies)
+    tps = measure_speed(space, ticks)
+    peak, kept = measure_allocations(space, min(ticks, 200))
+
+    return dict(
+        name=name,
+        bodies=bodies,
+        statics=len(space.static_bodies),
+        ticks=ticks,
+        ticks_per_second=tps,
+        us_per_body=1e6 / tps / max(bodies, 1),
+        peak_bytes_per_tick=peak,
+        kept_bytes_per_tick=kept,
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, reference=None):
+    reference = {r['name']: r for r in reference['results']} if reference else {}
+
+    print(f"{'scenario':<24} {'bodies':>6} {'statics':>7} {'ticks/s':>9} {'us/body':>8} {'peak B':>7} {'kept B':>7}")
+    for r in results:
+        line = (f"{r['name']:<24} {r['bodies']:>6} {r['statics']:>7} {r['ticks_per_second']:>9.0f} "
+                f"{r['us_per_body']:>8.2f} {r['peak_bytes_per_tick']:>7} {r['kept_bytes_per_tick']:>7.1f}")
+        ref = reference.get(r['name'])
+        if ref:
+            line += f"   x{r['ticks_per_second'] / ref['ticks_per_second']:.2f} speed"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark physics.Space.")
+    parser.add_argument("-n", "--bodies", type=int, default=20, help="number of moving bodies")
+    parser.add_argument("-m", "--statics", type=int, default=100, help="number of static AABBs in synthetic spaces")
+    parser.add_argument("-k", "--ticks", type=int, default=1000, help="number of ticks to simulate")
+    parser.add_argument("--level", default=LEVEL, help="level used for the level scenarios")
+    parser.add_argument("--sleep", action="store_true", help="let the bodies fall asleep")
+    parser.add_argument("--scenario", action="append", choices=("synthetic", "level-grid", "level-aabb"),
+                        help="scenarios to run (all of them by default)")
+    parser.add_argument("-o", "--output", help="save the results in this JSON file")
+    parser.add_argument("-c", "--compare", help="JSON file of previous results to compare with")
+    args = parser.parse_args()
+
+    scenarios = {
+        "synthetic": lambda: synthetic_space(args.bodies, args.statics, can_sleep=args.sleep),
+        "level-grid": lambda: level_space(args.bodies, args.level, 'grid', can_sleep=args.sleep),
+        "level-aabb": lambda: level_space(args.bodies, args.level, 'aabb', can_sleep=args.sleep),
+    }
+
+    results = []
+    for name in args.scenario or scenarios:
+        results.append(run_scenario(name, scenarios[name](), args.ticks))
+
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+    print_results(results, reference)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(commit=git_commit(), python=platform.python_version(), results=results), f, indent=2)
+        print(f"Results saved at {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+"""
+End to end benchmark of the game, without a window.
+
+The App is started with SDL's dummy video driver and a fixed screen size,
+then plays a scripted sequence of inputs (walk, jump, fire, toggle the lights...),
+or a session recorded with `python . --record`, with one update and one render per frame,
+as fast as possible. The game clock and random numbers are fixed, so every run does the same work.
+It reports the frame times and where they went:
+
+    python bench_app.py --frames 600 --output before.json
+    ... change things ...
+    python bench_app.py --frames 600 --compare before.json
+"""
+
+from time import perf_counter
+
+# for the time to first frame, as early as possible
+PROCESS_START = perf_counter()
+
+import argparse
+import json
+import os
+import platform
+
+# Must be set before pygame creates any window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from bench import git_commit
+from profiler import profiler
+from quality import LEVELS, DEFAULT_LEVEL
+
+# Stages in the order of a frame. The indented ones are part of the previous one.
+STAGES = ("update", "  physics", "render", "light update", "  visibility", "  light mask", "  composite", "  blur",
+          "apply light", "scale", "present")
+# the same, done by the light worker when the lights are threaded. They are not in the frame time.
+WORKER_STAGES = ("worker visibility", "worker light mask", "worker composite", "worker blur")
+
+# (frame, key, pressed) of a few seconds of play. It is repeated for the whole benchmark.
+SCRIPT = [
+    (0, pygame.K_l, True),  # more lights
+    (1, pygame.K_l, False),
+    (10, pygame.K_RIGHT, True),
+    (40, pygame.K_SPACE, True),
+    (60, pygame.K_SPACE, False),
+    (90, pygame.K_RIGHT, False),
+    (95, pygame.K_w, True),  # build a fire ball...
+    (130, pygame.K_w, False),  # ... and throw it
+    (140, pygame.K_LEFT, True),
+    (150, pygame.K_d, True),  # rapid fire
+    (170, pygame.K_SPACE, True),
+    (185, pygame.K_SPACE, False),
+    (200, pygame.K_d, False),
+    (230, pygame.K_LEFT, False),
+    (240, pygame.K_l, True),  # back to only the player's light
+    (241, pygame.K_l, False),
+]
+SCRIPT_LENGTH = 250
+# frames looked at for the startup times, before the warmup
+STARTUP_FRAMES = 60
+
+
+def post_inputs(frame):
+    frame %= SCRIPT_LENGTH
+    for f, key, pressed in SCRIPT:
+        if f == frame:
+            pygame.event.post(pygame.event.Event(pygame.KEYDOWN if pressed else pygame.KEYUP, key=key, mod=0))
+
+
+def run(frames, screen_size, warmup=60, replay=None, quality=None, threaded=True, presenter="software"):
+    """
+    Play the script for `frames` frames.
+
+    :param replay: file of recorded inputs played instead of the script
+    :param quality: name of the quality level used, the default one if None. It doesn't change during the run.
+    :param threaded: whether the lights are computed in a worker thread
+    :param presenter: how the game is scaled to the screen, see present.py
+    :return: the frame times, the time spent in each stage per frame, and the startup times (all in seconds)
+    """
+
+    # imported here so the environment is set before
+    from shade import App
+    from replay import start_session
+    imported = perf_counter()
+
+    if replay is None:
+        start_session(0, App.UPDATE_FPS)
+    App.THREADED_LIGHTS = threaded
+    app = App(screen_size, replay=replay, presenter=presenter)
+    app.ADAPTIVE_QUALITY = False
+    if quality is not None:
+        app.quality.set_level([level.name for level in LEVELS].index(quality))
+        app.apply_quality()
+    created = perf_counter()
+
+    # The startup: the first frames, while the masks are computed in the background
+    frame = 0
+    early_frames = []
+    first_frame = first_lit_frame = None
+    while frame < STARTUP_FRAMES and not app.stop:
+        if replay is None:
+            post_inputs(frame)
+        start = perf_counter()
+        app.tick()
+        app.draw()
+        end = perf_counter()
+        early_frames.append(end - start)
+        if first_frame is None:
+            # only with the ambient light, the mask of the player is not ready yet
+            first_frame = end
+        if first_lit_frame is None and app.warm_up.first_done.is_set():
+            first_lit_frame = end
+        frame += 1
+
+    startup = dict(
+        imports=imported - PROCESS_START,
+        init=created - imported,
+        first_frame=first_frame - created,
+        time_to_first_frame=first_frame - PROCESS_START,
+        time_to_lights=(first_lit_frame or perf_counter()) - PROCESS_START,
+        # the first frames are slower, while the masks are not all cached
+        slowest_early_frame=max(early_frames),
+    )
+
+    # so the frames measured don't share the CPU with it
+    app.warm_up.join()
+
+    profiler.enabled = True
+    frame_times = []
+    stages = []
+    for i in range(warmup + frames):
+        if replay is None:
+            post_inputs(frame + i)
+        elif app.stop:
+            break
+
+        start = perf_counter()
+        app.tick()
+        app.draw()
+        duration = perf_counter() - start
+
+        times = profiler.end_frame()
+        if i >= warmup:
+            frame_times.append(duration)
+            stages.append(times)
+    profiler.enabled = False
+
+    app.light_mask.close()
+    app.presenter.close()
+
+    return np.array(frame_times), stages, startup
+
+
+def summary(times):
+    """Mean and percentiles of times, in ms."""
+    times = np.asarray(times) * 1000
+    return dict(
+        mean=float(times.mean()),
+        p50=float(np.percentile(times, 50)),
+        p95=float(np.percentile(times, 95)),
+        p99=float(np.percentile(times, 99)),
+        max=float(times.max()),
+    )
+
+
+def print_results(results, reference=None):
+    def line(name, stats, ref_stats=None):
+        text = f"{name:<14} " + " ".join(f"{stats[k]:>7.2f}" for k in ("mean", "p50", "p95", "p99", "max"))
+        if ref_stats and ref_stats['mean']:
+            text += f"   x{stats['mean'] / ref_stats['mean']:.2f}"
+        return text
+
+    reference = reference or {}
+    print(f"{results['frames']} frames at {results['screen_size'][0]}x{results['screen_size'][1]}, in ms")
+    print(f"{'':<14} {'mean':>7} {'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}")
+    print(line("frame", results['frame'], reference.get('frame')))
+    for stage in STAGES:
+        name = stage.strip()
+        print(line(stage, results['stages'][name], reference.get('stages', {}).get(name)))
+    if any(results['stages'].get(name, {}).get('max') for name in WORKER_STAGES):
+        print("In the light worker, not in the frame:")
+        for name in WORKER_STAGES:
+            print(line("  " + name[len("worker "):], results['stages'][name], reference.get('stages', {}).get(name)))
+
+    print("Startup, in ms")
+    for name, t in results['startup'].items():
+        text = f"  {name:<20} {t:>8.1f}"
+        ref = reference.get('startup', {}).get(name)
+        if ref:
+            text += f"   x{t / ref:.2f}"
+        print(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the frames of the game, without a window.")
+    parser.add_argument("-f", "--frames", type=int, default=600, help="number of frames measured")
+    parser.add_argument("--warmup", type=int, default=60, help="number of frames before measuring, after the startup frames and the warm-up of the masks")
+    parser.add_argument("--size", type=int, nargs=2, default=(1920, 1080), metavar=("W", "H"),
+                        help="size of the (fake) screen")
+    parser.add_argument("--replay", metavar="FILE", help="play these recorded inputs instead of the script")
+    parser.add_argument("--quality", choices=[level.name for level in LEVELS],
+                        help="quality level of the lights (default: %(default)s)", default=LEVELS[DEFAULT_LEVEL].name)
+    parser.add_argument("--sync-lights", action="store_true", help="compute the lights in the main thread")
+    parser.add_argument("--present", choices=("software", "renderer"), default="software",
+                        help="how the game is scaled to the screen (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="save the results in this JSON file")
+    parser.add_argument("-c", "--compare", help="JSON file of previous results to compare with")
+    args = parser.parse_args()
+
+    frame_times, stages, startup = run(args.frames, tuple(args.size), args.warmup, args.replay, args.quality,
+                              not args.sync_lights, args.present)
+
+    results = dict(
+        commit=git_commit(),
+        python=platform.python_version(),
+        frames=len(frame_times),
+        replay=args.replay,
+        quality=args.quality,
+        threaded_lights=not args.sync_lights,
+        presenter=args.present,
+        screen_size=args.size,
+        startup={name: 1000 * t for name, t in startup.items()},
+        frame=summary(frame_times),
+        stages={name: summary([times.get(name, 0) for times in stages])
+                for name in (*(stage.strip() for stage in STAGES), *WORKER_STAGES)},
+    )
+
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+    print_results(results, reference)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved at {args.output}")
+
+
+if __name__ == '__main__':
+    main()
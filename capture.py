@@ -0,0 +1,113 @@
+"""
+Save screenshots and sequences of frames without stopping the game.
+
+Encoding a PNG takes a while, so the game only copies the frame into one of a few
+surfaces allocated in advance, and a background thread saves them.
+When the writer is late and all the surfaces wait to be saved, the frame is skipped
+(and counted in `dropped`) instead of slowing down the game.
+
+    capture = FrameCapture(GAME_SIZE)
+    capture.grab(back_screen, "recordings/frame-00001.png")
+    ...
+    capture.close()  # waits for the last frames to be saved
+"""
+
+import os
+import queue
+import threading
+
+import pygame
+
+
+class FrameCapture:
+    def __init__(self, size, buffers=8):
+        """
+        :param size: size of the frames grabbed, the buffers are allocated for it
+        :param buffers: number of frames that can wait to be saved
+        """
+
+        self.buffers = [pygame.Surface(size) for _ in range(buffers)]
+        self.free = queue.Queue()  # index of the buffers we can copy into
+        for i in range(buffers):
+            self.free.put(i)
+        self.todo = queue.Queue()  # (index of a buffer, path), None to stop
+
+        self.saved = 0
+        self.dropped = 0
+
+        self._writer = threading.Thread(target=self._run, name="frame writer", daemon=True)
+        self._writer.start()
+
+    def grab(self, surf, path):
+        """
+        Copy surf, to be saved at path by the writer.
+
+        :return: False if the frame was dropped, because all buffers are waiting to be saved
+        """
+
+        try:
+            i = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+
+        buffer = self.buffers[i]
+        if buffer.get_size() != surf.get_size():
+            # only happens once per buffer, for a screenshot of the whole display for instance
+            buffer = self.buffers[i] = pygame.Surface(surf.get_size())
+        buffer.blit(surf, (0, 0))
+        self.todo.put((i, path))
+        return True
+
+    def close(self):
+        """Wait for the frames grabbed to be saved."""
+        self.todo.put(None)
+        self._writer.join()
+
+    def _run(self):
+        while True:
+            job = self.todo.get()
+            if job is None:
+                return
+
+            i, path = job
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            pygame.image.save(self.buffers[i], path)
+            self.saved += 1
+            self.free.put(i)
+
+
+class FrameRecorder:
+    """Grab numbered frames at a fixed rate, in a directory."""
+
+    def __init__(self, capture, directory, fps=30):
+        self.capture = capture
+        self.directory = directory
+        self.interval = 1 / fps
+        self.next_time = None
+        self.frame = 0
+        self.dropped_before = capture.dropped
+
+    def frame_ready(self, surf, now):
+        """
+        Called with each frame drawn, only some are grabbed.
+
+        :param now: time of the frame, in seconds
+        """
+
+        if self.next_time is not None and now < self.next_time:
+            return
+        if self.next_time is None or now - self.next_time > self.interval:
+            # we started, or the game was too slow to keep the rate
+            self.next_time = now
+        self.next_time += self.interval
+
+        # the number goes on even when a frame is dropped, so the gaps show
+        self.frame += 1
+        self.capture.grab(surf, os.path.join(self.directory, f"frame-{self.frame:05}.png"))
+
+    @property
+    def dropped(self):
+        return self.capture.dropped - self.dropped_before
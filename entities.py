@@ -1,25 +1,31 @@
-from time import time
-
+from gameclock import time
 from light import RainbowLight
-from maths import clamp
-from physics import Body, AABB, Pos
+from physics import Pos
+
 
+class LightParticle(RainbowLight):
+    """
+    A light particle that is being built by the player.
+
+    Once fired, it is simulated by particles.LightParticles.
+    """
 
-class LightParticle(Body, RainbowLight):
     def __init__(self, center, velocity=(0, 0), life_time=None, range=40):
-        hit_box = 4
-        topleft = center[0] - hit_box, center[1] - hit_box
-        Body.__init__(self, AABB(topleft, (hit_box, hit_box)), mass=0,
-                      elasticity=1, moving=True)
         RainbowLight.__init__(self, center, range=range, loop_time=1, variants=3)
         self.velocity = Pos(velocity)
+        self.reset(center, velocity, life_time, range)
+
+    def reset(self, center, velocity=(0, 0), life_time=None, range=40):
+        """Make the particle as new, to reuse it."""
+        self.start = time()
+        self.center = center
+        self.range = range
+        self.variant = 0
+        self.velocity.set(*velocity)
         self.birthdate = time()
         self.life_time = life_time
         self.start_range = range
 
-    def __del__(self):
-        print("Une lumière s'est éteinte !")
-
     @property
     def life_time(self):
         return self._life_time
@@ -30,11 +36,19 @@ class LightParticle(Body, RainbowLight):
         self.start_range = self.range
         self.birthdate = time()
 
-    def update(self):
-        if self.life_time:
-            progress = (time() - self.birthdate) / self.life_time
-            self.range = clamp(round((1 - progress) * self.start_range), 0, self.start_range)
 
-    @property
-    def topleft(self):
-        return self.center - (self.range, self.range)
\ No newline at end of file
+class LightParticlePool:
+    """Recycle LightParticles, so firing a lot doesn't create new lights and masks each time."""
+
+    def __init__(self):
+        self.free = []
+
+    def acquire(self, center, velocity=(0, 0), life_time=None, range=40):
+        if self.free:
+            particle = self.free.pop()
+            particle.reset(center, velocity, life_time, range)
+            return particle
+        return LightParticle(center, velocity, life_time, range)
+
+    def release(self, particle):
+        self.free.append(particle)
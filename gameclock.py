@@ -0,0 +1,45 @@
+"""
+The time of the game.
+
+Everything that changes with time (rainbows, shrinking particles, growing fire balls...)
+asks this clock instead of time.time(). By default it is the wall clock, but it can
+also advance of a fixed step at each update, so that a recorded session replays
+exactly the same (see replay.py).
+
+    from gameclock import time
+"""
+
+from time import time as wall_time
+
+
+class GameClock:
+    def __init__(self):
+        self.step = None  # seconds per tick, None to follow the wall clock
+        self.now = 0.0
+
+    def time(self):
+        if self.step is None:
+            return wall_time()
+        return self.now
+
+    def use_fixed_step(self, step, start=0.0):
+        """From now on, time only advances of `step` seconds at each tick()."""
+        self.step = step
+        self.now = start
+
+    def use_wall_time(self):
+        self.step = None
+
+    def tick(self):
+        """Called once per update of the game."""
+        if self.step is not None:
+            self.now += self.step
+
+
+# The one used by the game
+clock = GameClock()
+
+
+def time():
+    """Same as time.time(), but from the game clock."""
+    return clock.time()
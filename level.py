@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Binary level format.
+
+The JSON levels are fine to edit by hand, but parsing thousands of "x y" keys is slow.
+A binary level is a small header followed by a raw int16 grid, so it can be memory-mapped
+and only the part we need is ever read from disk.
+
+Layout (little endian):
+    magic           4s      b"SHLV"
+    version         H
+    tile_size       H
+    origin          ii      map position of grid[0, 0]
+    shape           II      width, height (in tiles)
+    nb of paths     H
+    paths           for each: H (length) + utf-8 bytes
+    padding         to an even offset
+    grid            int16[height, width], -1 where there is no tile
+"""
+
+import json
+import struct
+import sys
+
+import numpy as np
+
+MAGIC = b"SHLV"
+VERSION = 1
+EMPTY = -1
+
+_HEADER = struct.Struct("<4sHHiiIIH")
+_PATH_LEN = struct.Struct("<H")
+
+
+class LevelHeader:
+    """Everything in a binary level except the grid."""
+
+    def __init__(self, tile_paths, tile_size, origin, shape, grid_offset=0, version=VERSION):
+        self.tile_paths = tile_paths
+        self.tile_size = tile_size
+        self.origin = origin
+        self.shape = shape  # (width, height)
+        self.grid_offset = grid_offset
+        self.version = version
+
+    def __repr__(self):
+        return f"<LevelHeader v{self.version}: {self.shape[0]}x{self.shape[1]} at {self.origin}, {self.tile_paths}>"
+
+    def pack(self):
+        data = bytearray(_HEADER.pack(MAGIC, self.version, self.tile_size, *self.origin, *self.shape,
+                                      len(self.tile_paths)))
+        for path in self.tile_paths:
+            path = path.encode()
+            data += _PATH_LEN.pack(len(path)) + path
+        if len(data) % 2:
+            data += b"\0"
+        return bytes(data)
+
+
+def is_binary_level(file):
+    """Whether the file starts with the magic of a binary level."""
+    with open(file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(file):
+    """Read the header of a binary level, without touching the grid."""
+
+    with open(file, "rb") as f:
+        magic, version, tile_size, ox, oy, w, h, nb_paths = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{file} is not a binary level")
+        if version > VERSION:
+            raise ValueError(f"{file} is a level of version {version}, but only up to {VERSION} is supported")
+
+        paths = []
+        for _ in range(nb_paths):
+            length, = _PATH_LEN.unpack(f.read(_PATH_LEN.size))
+            paths.append(f.read(length).decode())
+
+        offset = f.tell()
+        offset += offset % 2
+
+    return LevelHeader(paths, tile_size, (ox, oy), (w, h), offset, version)
+
+
+def read_grid(file, region=None, header=None):
+    """
+    Memory-map the tile grid of a binary level.
+
+    :param region: (x, y, w, h) in map coordinates. If given, only this rectangle
+        is returned (parts outside the level are EMPTY).
+    :return: the header and an int16 array indexed by [y, x]. Without region, this is a read only
+        view on the file and the grid starts at header.origin, otherwise it starts at the region's topleft.
+    """
+
+    if header is None:
+        header = read_header(file)
+
+    w, h = header.shape
+    if w * h == 0:
+        grid = np.full((h, w), EMPTY, dtype=np.int16)
+    else:
+        grid = np.memmap(file, dtype="<i2", mode="r", offset=header.grid_offset, shape=(h, w))
+
+    if region is None:
+        return header, grid
+
+    x, y, rw, rh = region
+    ox, oy = header.origin
+    out = np.full((rh, rw), EMPTY, dtype=np.int16)
+
+    # intersection of the region and the grid, in grid coordinates
+    x1, y1 = max(x - ox, 0), max(y - oy, 0)
+    x2, y2 = min(x + rw - ox, w), min(y + rh - oy, h)
+    if x1 < x2 and y1 < y2:
+        out[y1 + oy - y:y2 + oy - y, x1 + ox - x:x2 + ox - x] = grid[y1:y2, x1:x2]
+
+    return header, out
+
+
+def grid_to_tiles(grid, origin=(0, 0)):
+    """Convert a grid to the {(x, y): tile_id} dict used by TileMap."""
+    ys, xs = np.nonzero(grid != EMPTY)
+    ids = grid[ys, xs]
+    ox, oy = origin
+    return dict(zip(zip((xs + ox).tolist(), (ys + oy).tolist()), ids.tolist()))
+
+
+def tiles_to_grid(tiles):
+    """Convert a {(x, y): tile_id} dict to a grid and the map position of its topleft."""
+
+    if not tiles:
+        return np.full((0, 0), EMPTY, dtype=np.int16), (0, 0)
+
+    pos = np.array(list(tiles), dtype=np.int64)
+    ox, oy = pos.min(axis=0)
+    w, h = pos.max(axis=0) - (ox, oy) + 1
+
+    grid = np.full((h, w), EMPTY, dtype=np.int16)
+    grid[pos[:, 1] - oy, pos[:, 0] - ox] = list(tiles.values())
+
+    return grid, (int(ox), int(oy))
+
+
+def write_level(file, tiles, tile_paths, tile_size):
+    """Save tiles in the binary format."""
+
+    grid, origin = tiles_to_grid(tiles)
+    header = LevelHeader(list(tile_paths), tile_size, origin, (grid.shape[1], grid.shape[0]))
+
+    with open(file, "wb") as f:
+        f.write(header.pack())
+        f.write(grid.astype("<i2").tobytes())
+
+
+def read_json_level(file):
+    """Read a level in the old JSON format. Return the tiles, the tile paths and the tile size."""
+
+    with open(file, "r") as f:
+        d = json.loads(f.read())
+
+    tiles = {}
+    for pos_string, tile in d["tile_map"].items():
+        x, y = map(int, pos_string.split())
+        tiles[(x, y)] = tile
+
+    return tiles, d["tile_paths"], d["tile_size"]
+
+
+def convert(src, dest):
+    """Convert a JSON level to the binary format."""
+    write_level(dest, *read_json_level(src))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} JSON_LEVEL BINARY_LEVEL")
+        sys.exit(1)
+
+    convert(sys.argv[1], sys.argv[2])
+    print(read_header(sys.argv[2]))
@@ -1,14 +1,16 @@
+import threading
 from colorsys import hsv_to_rgb
+from concurrent.futures import ThreadPoolExecutor, Future
 from functools import lru_cache
-from time import time
+from time import perf_counter
 
 import numpy as np
-import scipy.ndimage
 import pygame
 import visibility
-from scipy.stats import truncnorm
 
+from gameclock import time
 from maths import expand_poly, clip_poly_to_rect
+from profiler import profiler
 
 GAUSSIAN = 42
 QUADRATIC = 2
@@ -37,6 +39,8 @@ class Light:
         # This will always be an array with 0s where the light from this light can't reach
         # up to 255 when it can
         self.alpha = None  # type: np.ndarray
+        # surfaces used by get_surf_mask, kept while the size doesn't change
+        self._surfs = None
         self.center = center
 
     def next_variant(self):
@@ -56,8 +60,9 @@ class Light:
 
         self.alpha = self.visible_mask(visible_poly)
 
+    # Not bounded, so the masks computed by MaskWarmUp stay cached (a few hundreds at most)
     @staticmethod
-    @lru_cache()
+    @lru_cache(maxsize=None)
     def compute_gauss_light_mask(radius, variant=0):
         """
         Generate a random mask of the area a light lights (without any wall)
@@ -66,6 +71,10 @@ class Light:
         :param variant: Anything hashable, different variant will generate slightly different masks.
         """
 
+        # scipy is imported only when needed, it takes a while
+        import scipy.ndimage
+        from scipy.stats import truncnorm
+
         mask = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
 
         # We genereate lots of random numbers with a truncated normal distribution
@@ -84,8 +93,11 @@ class Light:
         return mask
 
     @staticmethod
-    @lru_cache()
-    def compute_quad_light_mask(radius, variant=0):
+    @lru_cache(maxsize=None)
+    def compute_quad_light_mask(radius):
+        """The same for all variants, there is nothing random in it."""
+
+        import scipy.ndimage
 
         s = pygame.Surface((2 * radius, 2 * radius))
         # for r in range(radius - 4, 1, -1):
@@ -106,7 +118,7 @@ class Light:
         if self.light_shape == GAUSSIAN:
             return self.compute_gauss_light_mask(self.range, self.variant)
         if self.light_shape == QUADRATIC:
-            return self.compute_quad_light_mask(self.range, self.variant)
+            return self.compute_quad_light_mask(self.range)
         raise ValueError(f"Unkonwn light shape {self.light_shape}")
 
     def visible_mask(self, visible_poly):
@@ -154,10 +166,16 @@ class Light:
         """
         Return a pygame RGB surface with the colors indicating how much red,
         green and blue light reach each pixel.
+
+        The surface is reused by the next call, so blit it before calling this again.
         """
 
         # GOAL: encode the alpha array into a RGB colored surface
-        s = pygame.Surface(self.alpha.shape, pygame.SRCALPHA)
+        size = self.alpha.shape
+        if self._surfs is None or self._surfs[0].get_size() != size:
+            self._surfs = pygame.Surface(size, pygame.SRCALPHA), pygame.Surface(size)
+        s, s2 = self._surfs
+
         # We create a surface of the light's color with the correct per-pixel alpha
         s.fill(self.color)
         pix = pygame.surfarray.pixels_alpha(s)
@@ -168,10 +186,39 @@ class Light:
         # And then encode the alpha into the color
         # ie. (255, 200, 20) and an alpha of 128 -> (128, 100, 10)
         # since the final mask is the maximum possible color for each pixel
-        s2 = pygame.Surface(self.alpha.shape)
+        s2.fill((0, 0, 0))
         s2.blit(s, (0, 0))
         return s2
 
+    def warm_up(self):
+        """Compute the base masks of all the variants of this light, so they are cached."""
+        if self.light_shape == GAUSSIAN:
+            for variant in range(self.variants):
+                self.compute_gauss_light_mask(self.range, variant)
+        else:
+            self.compute_quad_light_mask(self.range)
+
+    def snapshot(self, into=None):
+        """
+        A plain Light frozen with the current center, color, range... of this one.
+
+        :param into: a previous snapshot to update instead of creating a new one. It keeps its mask.
+        """
+
+        center = tuple(self.center)
+        color = tuple(self.color)
+        if into is None:
+            into = Light(center, color, self.range, self.piercing, self.variants, self.light_shape)
+        else:
+            into.center = center
+            into.color = color
+            into.range = self.range
+            into.piercing = self.piercing
+            into.variants = self.variants
+            into.light_shape = self.light_shape
+        into.variant = self.variant
+        return into
+
     @property
     def topleft(self):
         """Position to blit the mask"""
@@ -203,10 +250,31 @@ class RainbowLight(Light):
         pass
 
 
+class MaskWarmUp(threading.Thread):
+    """
+    Compute the base masks of lights in the background, so that the first frames
+    don't wait for them. This also imports scipy, which takes a while.
+    """
+
+    def __init__(self, lights):
+        """
+        :param lights: the most needed first
+        """
+        super().__init__(name="light warm up", daemon=True)
+        self.lights = lights
+        # set once the masks of the first light are ready
+        self.first_done = threading.Event()
+
+    def run(self):
+        for light in self.lights:
+            light.warm_up()
+            self.first_done.set()
+
+
 class GlobalLightMask:
     """Base class that take care of merging all the lights together."""
 
-    def __init__(self, lights, size, shadow_caster, minimum_light=(0, 0, 0), blur=10):
+    def __init__(self, lights, size, shadow_caster, minimum_light=(0, 0, 0), blur=10, resolution=1):
         """
         Light combiner and renderer.
 
@@ -217,39 +285,83 @@ class GlobalLightMask:
         :param shadow_caster: A ShadowCaster object, containing the description of all the walls where
             the light is blocked.
         :param minimum_light: ambient light, useful to have wall that are not pure black
+        :param blur: size of the blur of the whole mask, 0 to not blur
+        :param resolution: the mask is blurred at 1/resolution of its size and scaled back, which is much faster
         """
 
         self.lights = lights
         self.size = size
         self.minimum_light = minimum_light
         self.blur = blur
+        self.resolution = resolution
         self.surf_mask = pygame.Surface(size)
+        self.surf_mask.fill(minimum_light)
+        self._small_mask = None  # type: pygame.Surface
         self.shadow_caster = shadow_caster  # type: visibility.VisibiltyCalculator
 
-    def update_mask(self):
+    def update_mask(self, lights=None):
         """
         Update the global mask according to each light's center and color.
 
         This merges (add) all the lights into `surf_mask`.
+
+        :param lights: if given, only those lights see their visible area computed again,
+            the others are merged with the mask they had on the previous update.
         """
 
-        # update each lights
-        for light in self.lights:
-            visible_poly = self.shadow_caster.visible_polygon(light.center)
-            light.update_mask(visible_poly)
+        self.compute_mask(self.lights, self.lights if lights is None else lights, self.surf_mask)
 
-        # reset the mask
-        self.surf_mask.fill(self.minimum_light)
+    def compute_mask(self, lights, updated, surf):
+        """Merge the lights on surf, after computing again the masks of the updated ones."""
 
-        # add them all
-        for light in self.lights:
-            # light is additive
-            self.surf_mask.blit(light.get_surf_mask(), light.topleft, None, pygame.BLEND_RGB_ADD)
+        # update each lights
+        tracer = profiler.tracer
+        for light in updated:
+            start = perf_counter()
+            with profiler.section("visibility"):
+                visible_poly = self.shadow_caster.visible_polygon(light.center)
+            with profiler.section("light mask"):
+                light.update_mask(visible_poly)
+            if tracer is not None:
+                # so we can see which light is slow
+                tracer.span("light", start, perf_counter(), "light", id=id(light), range=light.range,
+                            vertices=len(visible_poly), mask=light.alpha.shape)
+
+        with profiler.section("composite"):
+            # reset the mask
+            surf.fill(self.minimum_light)
+
+            # add them all
+            for light in lights:
+                # light is additive
+                surf.blit(light.get_surf_mask(), light.topleft, None, pygame.BLEND_RGB_ADD)
 
         if self.blur:
-            pix = pygame.surfarray.pixels3d(self.surf_mask)
-            for axis in range(3):
-                pix[:,:,axis] = scipy.ndimage.uniform_filter(pix[:,:,axis], self.blur)
+            with profiler.section("blur"):
+                if self.resolution > 1:
+                    self.blur_small(surf)
+                else:
+                    self.blur_surf(surf, self.blur)
+
+    @staticmethod
+    def blur_surf(surf, size):
+        import scipy.ndimage
+
+        pix = pygame.surfarray.pixels3d(surf)
+        for axis in range(3):
+            pix[:,:,axis] = scipy.ndimage.uniform_filter(pix[:,:,axis], size)
+
+    def blur_small(self, surf):
+        """Blur the mask at a lower resolution."""
+
+        small_size = (self.size[0] // self.resolution, self.size[1] // self.resolution)
+        if self._small_mask is None or self._small_mask.get_size() != small_size:
+            self._small_mask = pygame.Surface(small_size, 0, surf)
+
+        pygame.transform.scale(surf, small_size, self._small_mask)
+        self.blur_surf(self._small_mask, max(self.blur // self.resolution, 1))
+        # smooth, so the big pixels don't show
+        pygame.transform.smoothscale(self._small_mask, self.size, surf)
 
     def apply_light_on(self, surf, offset=(0, 0)):
         """
@@ -268,3 +380,69 @@ class GlobalLightMask:
         # Therefore we multiply it with the real color because that's how light works
         # I thought it was a minimum for a while, but it isn't
         surf.blit(self.surf_mask, offset, None, pygame.BLEND_RGB_MULT)
+
+    def close(self):
+        """Free what needs to be, when the mask is not used anymore."""
+
+
+class ThreadedLightMask(GlobalLightMask):
+    """
+    A GlobalLightMask that computes the next mask in a worker thread, while the game uses the last one.
+
+    update_mask takes a snapshot of the lights and gives it to the worker, and apply_light_on
+    uses the last mask that is finished. The lights are then one update late, but the main thread
+    doesn't wait for the visibility, the masks and the blur anymore.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the worker draws on back_mask, and surf_mask is the last finished one
+        self.back_mask = pygame.Surface(self.size)
+        # light -> its snapshot, that keeps its mask between updates
+        self._snapshots = {}
+        # its sections are apart from the ones of the main thread, they are not in the frame time
+        self._executor = ThreadPoolExecutor(1, "light mask",
+                                            initializer=profiler.name_thread, initargs=("worker ",))
+        self._job = None  # type: Future
+
+    def update_mask(self, lights=None):
+        """
+        Start computing the mask of the lights as they are now.
+
+        If the worker is still busy with the previous one, this update is skipped,
+        except when only some lights are updated, then we wait so they are not forgotten.
+        """
+
+        if self._job is not None:
+            if lights is None and not self._job.done():
+                return
+            self._job.result()
+            self.swap()
+
+        snapshots = {light: light.snapshot(self._snapshots.get(light)) for light in self.lights}
+        updated = {snapshots[light] for light in (self.lights if lights is None else lights)}
+        # the new lights don't have a mask yet
+        updated.update(snap for snap in snapshots.values() if snap.alpha is None)
+        self._snapshots = snapshots
+
+        self._job = self._executor.submit(self.compute_mask, list(snapshots.values()), updated, self.back_mask)
+
+    def swap(self):
+        """Use the last mask of the worker, if it finished one since the last swap."""
+        if self._job is not None and self._job.done():
+            self._job.result()  # so we see the errors of the worker
+            self.surf_mask, self.back_mask = self.back_mask, self.surf_mask
+            self._job = None
+
+    def apply_light_on(self, surf, offset=(0, 0)):
+        self.swap()
+        super().apply_light_on(surf, offset)
+
+    def wait(self):
+        """Wait for the worker to finish the mask it is computing, and use it."""
+        if self._job is not None:
+            self._job.result()
+            self.swap()
+
+    def close(self):
+        self._executor.shutdown()
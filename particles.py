@@ -0,0 +1,206 @@
+"""
+Light particles, simulated all at once with numpy.
+
+Each particle used to be a Body and a RainbowLight, moved one by one by the Space.
+Here we keep everything in arrays (struct of arrays) and update them in one go,
+only the light objects used to render them are python objects, and they are recycled.
+"""
+
+
+import numpy as np
+
+from gameclock import time
+from light import RainbowLight
+from physics import TileGrid
+
+
+class LightParticles:
+    """A set of bouncing light particles that shrink until they die."""
+
+    def __init__(self, hit_box=4, elasticity=1, gravity_factor=0, min_range=3, capacity=64):
+        """
+        :param hit_box: size of the square used for collisions, centered on the particles.
+            It must not be bigger than the tiles, only the tiles under its corners are checked.
+        :param elasticity: how much of their velocity they keep when they bounce
+        :param gravity_factor: how much the gravity of the space pulls them (their mass was 0)
+        :param min_range: particles with a range smaller than this die
+        :param capacity: number of particles we have room for before growing the arrays
+        """
+
+        self.hit_box = hit_box
+        self.elasticity = elasticity
+        self.gravity_factor = gravity_factor
+        self.min_range = min_range
+
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.previous_pos = np.zeros((capacity, 2))  # before the last update, to render in between
+        self.vel = np.zeros((capacity, 2))
+        self.range = np.zeros(capacity)
+        self.start_range = np.zeros(capacity)
+        self.birth = np.zeros(capacity)
+        self.life_time = np.zeros(capacity)  # 0 means they live forever
+        # The lights used to render the particles, aligned with the arrays.
+        # The ones after count are dead and wait to be reused.
+        self._lights = []
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def lights(self):
+        """The lights of the alive particles."""
+        return self._lights[:self.count]
+
+    def _grow(self):
+        capacity = 2 * len(self.pos)
+        for name in ('pos', 'previous_pos', 'vel', 'range', 'start_range', 'birth', 'life_time'):
+            old = getattr(self, name)
+            new = np.zeros((capacity, *old.shape[1:]))
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def emit(self, center, velocity=(0, 0), range=40, life_time=None, born=None):
+        """
+        Add a particle.
+
+        :param life_time: seconds it takes to shrink to nothing, None to never shrink
+        :param born: time at which it started to shrink and its rainbow started, default to now
+        """
+
+        if born is None:
+            born = time()
+
+        i = self.count
+        if i == len(self.pos):
+            self._grow()
+
+        self.pos[i] = center
+        self.previous_pos[i] = center
+        self.vel[i] = velocity
+        self.range[i] = range
+        self.start_range[i] = range
+        self.birth[i] = born
+        self.life_time[i] = life_time or 0
+        self.count += 1
+
+        if i == len(self._lights):
+            self._lights.append(RainbowLight(center, range=range, loop_time=1, variants=3))
+        light = self._lights[i]
+        light.start = born
+        light.center = center
+        light.range = range
+
+    def emit_particle(self, particle):
+        """Add a LightParticle that was built by the player."""
+        self.emit(particle.center, particle.velocity, particle.range, particle.life_time, particle.birthdate)
+
+    def update(self, space=None):
+        """Move the particles, bounce them on the tile grids of the space, shrink them and remove the dead ones."""
+
+        n = self.count
+        if not n:
+            return
+
+        pos = self.pos[:n]
+        vel = self.vel[:n]
+        self.previous_pos[:n] = pos
+
+        grids = []
+        if space is not None:
+            if self.gravity_factor:
+                vel += np.array(space.gravity) * self.gravity_factor
+            grids = [c for c in space.colliders if isinstance(c, TileGrid)]
+
+        # one axis after the other, like Body
+        for axis in (0, 1):
+            pos[:, axis] += vel[:, axis]
+            for grid in grids:
+                self._collide(grid, axis)
+
+        # shrink
+        life = self.life_time[:n]
+        mortal = life > 0
+        progress = (time() - self.birth[:n][mortal]) / life[mortal]
+        start = self.start_range[:n][mortal]
+        self.range[:n][mortal] = np.clip(np.round((1 - progress) * start), 0, start)
+
+        # remove the dead, last first, so the swap never brings a dead one in
+        for i in np.flatnonzero(self.range[:n] < self.min_range)[::-1]:
+            self._swap_remove(i)
+
+        for light, (x, y), range_ in zip(self._lights, self.pos[:self.count].tolist(), self.range[:self.count].tolist()):
+            light.center = x, y
+            light.range = int(range_)
+
+    def place_lights(self, alpha=1.0):
+        """
+        Put the lights between the positions before and after the last update.
+
+        :param alpha: 0 for the previous position, 1 for the last one
+        """
+
+        n = self.count
+        previous = self.previous_pos[:n]
+        centers = previous + (self.pos[:n] - previous) * alpha
+        for light, (x, y) in zip(self._lights, centers.tolist()):
+            light.center = x, y
+
+    def _swap_remove(self, i):
+        last = self.count - 1
+        for array in (self.pos, self.previous_pos, self.vel, self.range, self.start_range, self.birth, self.life_time):
+            array[i] = array[last]
+        lights = self._lights
+        lights[i], lights[last] = lights[last], lights[i]
+        self.count -= 1
+
+    def _collide(self, grid, axis):
+        """Push the particles out of the solid tiles along the axis, and bounce them."""
+
+        n = self.count
+        pos = self.pos[:n]
+        vel = self.vel[:n, axis]
+        ts = grid.tile_size
+        # otherwise a tile could be under the middle of the hit box but not under its corners
+        assert self.hit_box <= ts, f"hit box of {self.hit_box} px, bigger than the tiles of {ts} px"
+        solid, origin = grid.solid_array()
+
+        half = self.hit_box / 2
+        low = pos - half
+        high = pos + half
+        # first and last tiles that strictly overlap the hit box, as in TileGrid.query
+        first = np.floor(low / ts).astype(int)
+        last = np.ceil(high / ts).astype(int) - 1
+
+        def is_solid(x, y):
+            x = x - origin[0]
+            y = y - origin[1]
+            inside = (0 <= x) & (x < solid.shape[0]) & (0 <= y) & (y < solid.shape[1])
+            result = np.zeros(n, dtype=bool)
+            result[inside] = solid[x[inside], y[inside]]
+            return result
+
+        other = 1 - axis
+
+        def hits(line):
+            """Whether there is a solid tile on this line (along the axis) under the hit box."""
+            cells = [None, None]
+            cells[axis] = line
+            cells[other] = first[:, other]
+            hit = is_solid(*cells)
+            cells[other] = last[:, other]
+            return hit | is_solid(*cells)
+
+        hit_first = hits(first[:, axis])
+        hit_last = hits(last[:, axis])
+        hit = hit_first | hit_last
+
+        # going forward we stop on the closest tile, going backward on the farthest
+        forward = hit & (vel > 0)
+        backward = hit & (vel < 0)
+        stop_forward = np.where(hit_first, first[:, axis], last[:, axis]) * ts - half
+        stop_backward = (np.where(hit_last, last[:, axis], first[:, axis]) + 1) * ts + half
+
+        pos[forward, axis] = stop_forward[forward]
+        pos[backward, axis] = stop_backward[backward]
+        vel[forward | backward] *= -self.elasticity
@@ -4,16 +4,26 @@ Custom physics engine that take care only of AABBs.
 Maybe one day it'll get bigger.
 """
 
-from math import cos, sin, pi, sqrt
+from collections import defaultdict
+from math import cos, sin, pi, sqrt, floor, ceil
 from typing import List
 
+import numpy as np
 import pygame
 
 from maths import clamp
+from profiler import profiler
 
 
 class Pos:
-    """A vector."""
+    """
+    A vector.
+
+    The operators return new vectors, but the in-place ones (+=, iadd, set...)
+    don't allocate anything, so use them in the hot paths.
+    """
+
+    __slots__ = ('x', 'y')
 
     def __init__(self, *args):
         if len(args) == 1:
@@ -45,31 +55,56 @@ class Pos:
         raise IndexError(f"Pos has no item {item}")
 
     def __add__(self, other):
-        return Pos(self[0] + other[0], self[1] + other[1])
+        return Pos(self.x + other[0], self.y + other[1])
 
     def __radd__(self, other):
         return Pos(self.x + other[0], self.y + other[1])
 
+    def __iadd__(self, other):
+        self.x += other[0]
+        self.y += other[1]
+        return self
+
     def __sub__(self, other):
-        return Pos(self[0] - other[0], self[1] - other[1])
+        return Pos(self.x - other[0], self.y - other[1])
 
     def __rsub__(self, other):
-        return Pos(other[0] - self[0], other[1] - self[1])
+        return Pos(other[0] - self.x, other[1] - self.y)
+
+    def __isub__(self, other):
+        self.x -= other[0]
+        self.y -= other[1]
+        return self
 
     def __neg__(self):
-        return Pos(-self[0], -self[1])
+        return Pos(-self.x, -self.y)
 
     def __mul__(self, other):
-        return Pos(self[0] * other, self[1] * other)
+        return Pos(self.x * other, self.y * other)
 
     def __rmul__(self, other):
         return Pos(self.x * other, self.y * other)
 
+    def __imul__(self, other):
+        self.x *= other
+        self.y *= other
+        return self
+
     def __truediv__(self, other: int):
-        return Pos(self[0] / other, self[1] / other)
+        return Pos(self.x / other, self.y / other)
 
     def __floordiv__(self, other: int):
-        return Pos(self[0] // other, self[1] // other)
+        return Pos(self.x // other, self.y // other)
+
+    def set(self, x, y):
+        """Change both coordinates in place."""
+        self.x = x
+        self.y = y
+
+    def iadd(self, x, y):
+        """Add x and y in place, without needing a vector or a tuple."""
+        self.x += x
+        self.y += y
 
     @property
     def t(self):
@@ -108,7 +143,14 @@ class Pos:
 
 
 class AABB:
-    """Axis aligned rectangle: the basic shape."""
+    """
+    Axis aligned rectangle: the basic shape.
+
+    All the sides are computed from topleft and size without allocating,
+    only center and half_size return new vectors.
+    """
+
+    __slots__ = ('topleft', 'size')
 
     def __init__(self, *args):
         """Create a axis aligned rectangle. Args a in the same style as pygame.Rect args."""
@@ -165,7 +207,15 @@ class AABB:
 
     @center.setter
     def center(self, value):
-        self.topleft = Pos(value) - self.half_size
+        self.topleft.set(value[0] - self.size.x / 2, value[1] - self.size.y / 2)
+
+    @property
+    def center_x(self):
+        return self.topleft.x + self.size.x / 2
+
+    @property
+    def center_y(self):
+        return self.topleft.y + self.size.y / 2
 
     @property
     def half_size(self):
@@ -213,15 +263,27 @@ class AABB:
 
 
 class Body:
-    """A moving object."""
+    """
+    A moving object.
+
+    Bodies that stay at rest for a while fall asleep and are not simulated anymore.
+    They wake up when their velocity or acceleration is set, on apply_impulse or accelerate,
+    when they are moved, or when a static near them changes. Changing the velocity in place
+    (body.velocity.x = ...) doesn't wake them, call wake() for this.
+    """
 
-    def __init__(self, shape, mass=1, elasticity=0, max_velocity=(None, None), moving=False, space=None):
+    def __init__(self, shape, mass=1, elasticity=0, max_velocity=(None, None), moving=False, space=None,
+                 can_sleep=True):
 
         self.elasticity = elasticity
         self.mass = mass
         self.shape = shape  # type: AABB
         self.space = space  # type: Space
 
+        self.can_sleep = can_sleep
+        self.sleeping = False
+        self.rest_ticks = 0
+
         self.velocity = Pos(0, 0)
         self.max_velocity = Pos(max_velocity)
         self.acceleration = Pos(0, 0)
@@ -233,6 +295,9 @@ class Body:
         self.collide_right = False
         self.collide_top = False
 
+        # the area swept by the last move, kept to avoid allocations
+        self._swept = AABB((0, 0), (0, 0))
+
     def __repr__(self):
         return f"<Body: s {self.shape}, v {self.velocity}, a {self.acceleration}>"
 
@@ -247,60 +312,174 @@ class Body:
     @center.setter
     def center(self, value):
         self.shape.center = value
+        self.wake()
+
+    @property
+    def velocity(self):
+        return self._velocity
+
+    @velocity.setter
+    def velocity(self, value):
+        self._velocity = value
+        self.wake()
+
+    @property
+    def acceleration(self):
+        return self._acceleration
+
+    @acceleration.setter
+    def acceleration(self, value):
+        self._acceleration = value
+        self.wake()
+
+    def apply_impulse(self, x, y):
+        """Add (x, y) to the velocity."""
+        self._velocity.iadd(x, y)
+        self.wake()
+
+    def accelerate(self, x, y):
+        """Add (x, y) to the acceleration, for this tick."""
+        self._acceleration.iadd(x, y)
+        self.wake()
+
+    def wake(self):
+        self.rest_ticks = 0
+        if self.sleeping and self.space is not None:
+            self.space.wake(self)
+
+    def at_rest(self, gravity):
+        """Whether the body didn't move this tick and won't move the next one."""
+        v = self._velocity
+        if abs(v.x) > Space.SLEEP_VELOCITY:
+            return False
+        if self.collide_down and self.mass:
+            # A bouncy body on the ground bounces a tiny bit on each tick, from the gravity
+            # of that tick (it settles at -g.e/(1+e)), which is not a reason to stay awake.
+            return abs(v.y) <= abs(gravity.y) / self.mass + Space.SLEEP_VELOCITY
+        if abs(v.y) > Space.SLEEP_VELOCITY:
+            return False
+        # without something below, gravity will make it fall
+        return not self.mass or not (gravity.x or gravity.y)
 
-    def update_x(self, shapes):
-        """Updates the position on the x coordinate and check for collision with the shapes."""
+    def update_x(self, colliders):
+        """
+        Updates the position on the x coordinate and check for collision with the static colliders.
+
+        :param colliders: objects with a query(shape) method that return the bounds of
+            what collides with the shape, like SpatialHash or TileGrid
+        """
         self.collide_left = False
         self.collide_right = False
         self.velocity.x += self.acceleration.x
         self.clamp_speed()
-        self.shape.x += self.velocity.x
-
-        intersect = [s for s in shapes if self.shape.collide(s)]
-
-        if self.velocity.x > 0:
-            # we are going right
-            for body in intersect:
-                if body.left < self.shape.right:
-                    self.shape.right = body.left
-                    self.velocity.x *= -self.elasticity
-                    self.collide_right = True
-        elif self.velocity.x < 0:
-            # we are going left
-            for body in intersect:
-                if self.shape.left < body.right:
-                    self.shape.left = body.right
-                    self.velocity.x *= -self.elasticity
-                    self.collide_left = True
-
         self.acceleration.x = 0
+        self.move_x(self.velocity.x, colliders)
 
-    def update_y(self, shapes):
+    def update_y(self, colliders):
         self.collide_down = False
         self.collide_top = False
-
         self.velocity.y += self.acceleration.y
         self.clamp_speed()
-        self.shape.y += self.velocity.y
+        self.acceleration.y = 0
+        self.move_y(self.velocity.y, colliders)
+
+    def move_x(self, dx, colliders):
+        """
+        Move by dx and stop at the first static on the way.
 
-        intersect = [s for s in shapes if self.shape.collide(s)]
+        We look for collisions in the whole area swept by the move (and not only at the end),
+        so fast bodies can't go through walls thinner than their speed.
+        """
+
+        shape = self.shape
+        swept = self._swept
+        swept.topleft.set(shape.left + min(dx, 0), shape.top)
+        swept.size.set(shape.size.x + abs(dx), shape.size.y)
+        shape.x += dx
 
-        if self.velocity.y > 0:
+        # we stop at the nearest static, and bounce only once even if there are several behind it
+        if dx > 0:
+            # we are going right
+            stop = shape.right
+            for collider in colliders:
+                for left, top, right, bottom in collider.query(swept):
+                    if left < stop:
+                        stop = left
+            if stop < shape.right:
+                shape.right = stop
+                self.velocity.x *= -self.elasticity
+                self.collide_right = True
+        elif dx < 0:
+            # we are going left
+            stop = shape.left
+            for collider in colliders:
+                for left, top, right, bottom in collider.query(swept):
+                    if right > stop:
+                        stop = right
+            if stop > shape.left:
+                shape.left = stop
+                self.velocity.x *= -self.elasticity
+                self.collide_left = True
+
+    def move_y(self, dy, colliders):
+        """Move by dy and stop at the first static on the way. See move_x."""
+
+        shape = self.shape
+        swept = self._swept
+        swept.topleft.set(shape.left, shape.top + min(dy, 0))
+        swept.size.set(shape.size.x, shape.size.y + abs(dy))
+        shape.y += dy
+
+        if dy > 0:
             # we are going down
-            for body in intersect:
-                if self.shape.bottom > body.top:
-                    self.shape.bottom = body.top
-                    self.velocity.y *= -self.elasticity
-                    self.collide_down = True
-        elif self.velocity.y < 0:
+            stop = shape.bottom
+            for collider in colliders:
+                for left, top, right, bottom in collider.query(swept):
+                    if top < stop:
+                        stop = top
+            if stop < shape.bottom:
+                shape.bottom = stop
+                self.velocity.y *= -self.elasticity
+                self.collide_down = True
+        elif dy < 0:
             # we are going up
-            for body in intersect:
-                if body.bottom > self.shape.top:
-                    self.shape.top = body.bottom
-                    self.velocity.y *= -self.elasticity
-                    self.collide_top = True
+            stop = shape.top
+            for collider in colliders:
+                for left, top, right, bottom in collider.query(swept):
+                    if bottom > stop:
+                        stop = bottom
+            if stop > shape.top:
+                shape.top = stop
+                self.velocity.y *= -self.elasticity
+                self.collide_top = True
+
+    def substeps(self, max_step, max_substeps=8):
+        """Number of steps needed so the body never moves more than max_step pixels at once on an axis."""
+        speed = max(abs(self.velocity.x + self.acceleration.x), abs(self.velocity.y + self.acceleration.y))
+        return clamp(ceil(speed / max_step), 1, max_substeps)
+
+    def step(self, colliders, substeps=1):
+        """
+        Apply the acceleration and move the body, in substeps small moves.
 
-        self.acceleration.y = 0
+        Each substep moves on x then on y, so bodies follow their diagonal more closely.
+        """
+
+        if substeps == 1:
+            self.update_x(colliders)
+            self.update_y(colliders)
+            return
+
+        self.collide_left = self.collide_right = False
+        self.collide_top = self.collide_down = False
+        self._velocity.iadd(self._acceleration.x, self._acceleration.y)
+        self.clamp_speed()
+        self._acceleration.set(0, 0)
+
+        for _ in range(substeps):
+            # the velocity may have changed after a bounce
+            self.move_x(self.velocity.x / substeps, colliders)
+            self.move_y(self.velocity.y / substeps, colliders)
 
     def clamp_speed(self):
         if self.max_velocity.x is not None:
@@ -309,32 +488,266 @@ class Body:
             self.velocity.y = clamp(self.velocity.y, -self.max_velocity.y, self.max_velocity.y)
 
 
+class SpatialHash:
+    """
+    Uniform grid of static AABBs, so a body only looks at the statics around it.
+
+    The shapes are stored by their bounds (left, top, right, bottom), as they don't move.
+    """
+
+    def __init__(self, cell_size=32):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+
+    def cells_under(self, left, top, right, bottom):
+        """All the cells overlapped by the rectangle."""
+        cs = self.cell_size
+        for x in range(floor(left / cs), ceil(right / cs)):
+            for y in range(floor(top / cs), ceil(bottom / cs)):
+                yield x, y
+
+    def add(self, shape):
+        bounds = shape.left, shape.top, shape.right, shape.bottom
+        for cell in self.cells_under(*bounds):
+            self.cells[cell].append(bounds)
+
+    def query(self, shape):
+        """Return the bounds of every static that collides with the shape."""
+
+        left, top, right, bottom = shape.left, shape.top, shape.right, shape.bottom
+        cells = self.cells
+
+        found = None
+        for cell in self.cells_under(left, top, right, bottom):
+            if cell not in cells:
+                # don't fill the defaultdict with empty cells
+                continue
+            for bounds in cells[cell]:
+                # same as AABB.collide_aabb
+                if right <= bounds[0] or bounds[2] <= left:
+                    continue
+                if bottom <= bounds[1] or bounds[3] <= top:
+                    continue
+                if found is None:
+                    found = set()
+                found.add(bounds)
+
+        # most of the time there is nothing, so we don't create a new set for nothing
+        return found or ()
+
+
+class TileGrid:
+    """
+    Static collider for a grid of solid tiles.
+
+    Instead of a list of shapes, we look directly at the tiles under a body,
+    so the cost only depends on the size of the body.
+    """
+
+    def __init__(self, solid=(), tile_size=16):
+        """
+        :param solid: map positions of the solid tiles
+        :param tile_size: size of a tile in world coordinates
+        """
+        self.tile_size = tile_size
+        self.solid = set(solid)
+        self.space = None  # type: Space
+        self._array = None
+
+    def add(self, map_pos):
+        self.solid.add(map_pos)
+        self.changed(map_pos)
+
+    def remove(self, map_pos):
+        self.solid.discard(map_pos)
+        self.changed(map_pos)
+
+    def changed(self, map_pos):
+        self._array = None
+        if self.space is not None:
+            ts = self.tile_size
+            x, y = map_pos
+            self.space.wake_in(x * ts, y * ts, (x + 1) * ts, (y + 1) * ts)
+
+    def solid_array(self):
+        """
+        The solid tiles as a boolean array, for collisions in bulk.
+
+        :return: the array indexed by [x, y] and the map position of array[0, 0]
+        """
+
+        if self._array is None:
+            if self.solid:
+                pos = np.array(list(self.solid))
+                origin = pos.min(axis=0)
+                array = np.zeros(pos.max(axis=0) - origin + 1, dtype=bool)
+                array[pos[:, 0] - origin[0], pos[:, 1] - origin[1]] = True
+            else:
+                origin = np.zeros(2, dtype=int)
+                array = np.zeros((0, 0), dtype=bool)
+            self._array = array, origin
+
+        return self._array
+
+    def query(self, shape):
+        """Return the bounds of every solid tile that collides with the shape."""
+
+        ts = self.tile_size
+        solid = self.solid
+        left, top, right, bottom = shape.left, shape.top, shape.right, shape.bottom
+
+        # tiles that strictly overlap the shape, as in AABB.collide_aabb
+        found = None
+        for x in range(floor(left / ts), ceil(right / ts)):
+            for y in range(floor(top / ts), ceil(bottom / ts)):
+                if (x, y) in solid:
+                    if found is None:
+                        found = []
+                    found.append((x * ts, y * ts, (x + 1) * ts, (y + 1) * ts))
+
+        return found or ()
+
+
+class Registry:
+    """
+    A list of bodies with O(1) add and remove.
+
+    Removing swaps the body with the last one, so the order is not kept.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, item):
+        return self.items[item]
+
+    def __contains__(self, item):
+        return item in self.index
+
+    def add(self, item):
+        if item not in self.index:
+            self.index[item] = len(self.items)
+            self.items.append(item)
+
+    def remove(self, item):
+        i = self.index.pop(item)
+        last = self.items.pop()
+        if last is not item:
+            self.items[i] = last
+            self.index[last] = i
+
+
 class Space:
-    def __init__(self, gravity=(0, 0)):
+    # Bodies that are at rest for this number of ticks are put to sleep
+    SLEEP_TICKS = 30
+    # and are considered at rest when they move slower than this
+    SLEEP_VELOCITY = 0.05
+
+    def __init__(self, gravity=(0, 0), cell_size=32, max_step=None):
+        """
+        :param max_step: if given, bodies faster than this (in pixels per tick)
+            are moved in several substeps. Collisions are checked along the whole move
+            anyway, so this is only needed for more precision, not to avoid tunneling.
+        """
         self.gravity = Pos(gravity)
-        self.static_bodies = []  # type: List[Body]
-        self.moving_bodies = []  # type: List[Body]
+        self.max_step = max_step
+        self.static_bodies = []  # type: List[AABB]
+        self.moving_bodies = Registry()
+        # only those are simulated
+        self.awake_bodies = Registry()
+        self.static_hash = SpatialHash(cell_size)
+        # Everything bodies can collide with. The static_hash is added with the first AABB
+        self.colliders = []
 
     def add(self, *bodies):
         for body in bodies:
             if isinstance(body, AABB):
+                if not self.static_bodies:
+                    self.colliders.append(self.static_hash)
                 self.static_bodies.append(body)
+                self.static_hash.add(body)
+            elif isinstance(body, TileGrid):
+                self.colliders.append(body)
+                body.space = self
             else:
-                self.moving_bodies.append(body)
-            body.space = self
+                self.moving_bodies.add(body)
+                if not body.sleeping:
+                    self.awake_bodies.add(body)
+                body.space = self
+
+    def remove(self, body):
+        """Remove a moving body from the space, in constant time."""
+        self.moving_bodies.remove(body)
+        if body in self.awake_bodies:
+            self.awake_bodies.remove(body)
+        body.space = None
+        # so it is awake when added again, in this space or another
+        body.sleeping = False
+        body.rest_ticks = 0
+
+    def wake(self, body):
+        """Put a sleeping body back in the simulation."""
+        if body.sleeping:
+            body.sleeping = False
+            body.rest_ticks = 0
+            self.awake_bodies.add(body)
+
+    def wake_in(self, left, top, right, bottom):
+        """Wake the bodies touching the rectangle, for instance because a static there changed."""
+        for body in self.moving_bodies:
+            if not body.sleeping:
+                continue
+            shape = body.shape
+            # touching is enough, they may be resting on it
+            if shape.right < left or right < shape.left or shape.bottom < top or bottom < shape.top:
+                continue
+            self.wake(body)
 
     def simulate(self):
-        for body in self.moving_bodies:
-            if body.mass:
-                body.acceleration += self.gravity / body.mass
+        with profiler.section("physics"):
+            self._simulate()
 
-        # check collision horizontally
-        # we don't do both at the same time because it simplifies A LOT the thing
-        # plus it's accurate enough
+    def _simulate(self):
+        awake = self.awake_bodies
 
-        for body in self.moving_bodies:
-            body.update_x(self.static_bodies)
+        gx, gy = self.gravity.x, self.gravity.y
+        for body in awake:
+            if body.mass:
+                body.acceleration.iadd(gx / body.mass, gy / body.mass)
+
+        # bodies don't collide with each other, so we can move them one after the other
+        colliders = self.colliders
+        max_step = self.max_step
+        fell_asleep = None
+        for body in awake:
+            if max_step is None:
+                # check collision horizontally then vertically
+                # we don't do both at the same time because it simplifies A LOT the thing
+                # plus it's accurate enough
+                body.update_x(colliders)
+                body.update_y(colliders)
+            else:
+                body.step(colliders, body.substeps(max_step))
+
+            if body.can_sleep and body.at_rest(self.gravity):
+                body.rest_ticks += 1
+                if body.rest_ticks >= self.SLEEP_TICKS:
+                    body.sleeping = True
+                    body.velocity.set(0, 0)
+                    if fell_asleep is None:
+                        fell_asleep = []
+                    fell_asleep.append(body)
+            else:
+                body.rest_ticks = 0
 
-        # check collision vertically
-        for body in self.moving_bodies:
-            body.update_y(self.static_bodies)
+        # we can't remove them while iterating
+        if fell_asleep:
+            for body in fell_asleep:
+                awake.remove(body)
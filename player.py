@@ -1,11 +1,13 @@
 from random import random
-from time import time
 
 import pygame
 
-from entities import LightParticle
+from assets import assets
+from entities import LightParticle, LightParticlePool
+from gameclock import time
 from light import Light
-from maths import Pos, clamp
+from maths import clamp
+from particles import LightParticles
 from physics import Body, AABB
 
 MAX_PLAYER_SPEED = (3, 6)
@@ -20,22 +22,24 @@ HOVERING_GRAVITY_FACTOR = 0.5
 LIGHT_COLOR = (100, ) * 3
 LIGHT_PIERCING = 5
 SIGHT = 69
-LIGHT_EMIT_DELAY = 10
-LIGHT_LIFE_TIME = 10
+# All the ranges a fire ball goes through, while it grows and then shrinks
+FIRE_BALL_RANGES = range(3, 61)
 
 
-class Player:
-    building_fire: LightParticle
+class PlayerPhysics:
+    """
+    How the player moves, without anything to draw.
 
-    def __init__(self):
+    It doesn't need a display, so it can be simulated headless (see batch.py).
+    """
 
-        # image and shape
-        img = pygame.image.load("assets/wizzard.png").convert_alpha()
-        # img.set_colorkey((255, 0, 255))
-        self._img = img
-        self._img_flipped = pygame.transform.flip(img, True, False)
-        self.sprite_offset = (1, 0)
-        shape = AABB((42, 8), (16, 26))
+    # Bits of the inputs for set_input
+    LEFT = 1
+    RIGHT = 2
+    JUMP = 4
+
+    def __init__(self, topleft=(42, 8)):
+        shape = AABB(topleft, (16, 26))
 
         self.direction = [False, False]
         self.looking_left = True
@@ -43,16 +47,101 @@ class Player:
         self.hovering = False
         self.wall_jump = 0
         self.jump_frames = 0
+        self.held = 0
+
+        # the player is controlled every tick, so it never sleeps
+        self.body = Body(shape, max_velocity=MAX_PLAYER_SPEED, moving=True, can_sleep=False)
+
+    def press_jump(self):
+        self.hovering = True
+        if self.body.collide_down:
+            self.jumping = True
+            self.body.velocity.y += JUMP_IMPULSE
+        elif self.body.collide_left:
+            self.jumping = False
+            self.wall_jump = 1
+            self.body.velocity.set(*WALLJUMP_IMPULSE)
+        elif self.body.collide_right:
+            self.jumping = False
+            self.wall_jump = -1
+            self.body.velocity.set(-WALLJUMP_IMPULSE[0], WALLJUMP_IMPULSE[1])
+
+    def release_jump(self):
+        self.jumping = False
+        self.hovering = False
+        self.wall_jump = 0
+        self.jump_frames = 0
+
+    def set_input(self, held):
+        """
+        Set which of LEFT, RIGHT and JUMP are held (as bits), like pressing and releasing the keys.
+        """
+
+        changed = held ^ self.held
+        self.held = held
+        self.direction[0] = bool(held & self.LEFT)
+        self.direction[1] = bool(held & self.RIGHT)
+        if changed & self.JUMP:
+            if held & self.JUMP:
+                self.press_jump()
+            else:
+                self.release_jump()
+
+    def update_movement(self):
+        if self.direction[0] == self.direction[1]:
+            self.body.velocity.x = 0
+        elif self.direction[0]:
+            self.body.acceleration.x -= WALK_ACCELERATION
+            self.looking_left = True
+        elif self.direction[1]:
+            self.looking_left = False
+            self.body.acceleration.x += WALK_ACCELERATION
+
+        ay = 0
+        if self.jumping:
+            # we almost cancel gravity for the first frames and then less and less
+            ay = self.body.space.gravity.y * clamp(1 - self.jump_frames / JUMP_DURATION, 0, 1)
+            self.jump_frames += 1
+        elif self.wall_jump:
+            ay = self.body.space.gravity.y * clamp(1 - self.jump_frames / WALLJUMP_DURATION, 0, 1)
+            # self.body.acceleration.x += self.wall_jump * ay
+            self.jump_frames += 1
+        elif self.hovering:
+            # if we go down when hovering, we reduce the gravity
+            if self.body.velocity.y > 0:
+                ay += self.body.space.gravity.y * HOVERING_GRAVITY_FACTOR
+
+        # after a jump we want to quickly start going down for more control
+        # hovering but going up is not wanted
+        if not self.jumping and not self.wall_jump and self.body.velocity.y < 0:
+            self.body.velocity.y /= JUMP_BRAKE_STRENGTH
+
+        self.body.acceleration.y -= ay
+
+
+class Player(PlayerPhysics):
+    building_fire: LightParticle
+
+    def __init__(self):
+        super().__init__()
+
+        # image
+        # shared by all the players
+        self._img = assets.acquire("assets/wizzard.png", alpha=True)
+        self._img_flipped = assets.acquire("assets/wizzard.png", flip=True, alpha=True)
+        self.sprite_offset = (1, 0)
+
         self.firing = False
         self.fire_time = 0
         self.building_fire = None
         self.raffale = False
 
-        self.body = Body(shape, max_velocity=MAX_PLAYER_SPEED, moving=True)
+        # where the player was before the last physics step, to render in between
+        self.previous_topleft = tuple(self.body.shape.topleft)
 
         self.light = Light(self.light_pos, LIGHT_COLOR, SIGHT, LIGHT_PIERCING, variants=10)
-        self.lights = []
-        self.last_light_emit_time = 0
+        self.particles = LightParticles()
+        self.particle_pool = LightParticlePool()
 
     @property
     def img(self):
@@ -63,31 +152,26 @@ class Player:
 
     @property
     def light_pos(self):
-        r = self.get_rect()
+        shape = self.body.shape
+        return self.light_pos_at(shape.left, shape.top)
+
+    def light_pos_at(self, left, top):
+        """Where the light is when the player's topleft is at (left, top)."""
+        # same as rounding the shape to a pygame.Rect, without creating one
+        y = int(top) + 7
         if self.looking_left:
-            return r.topleft + Pos(1, 7)
+            return int(left) + 1, y
         else:
-            return r.topright + Pos(-3, 7)
+            return int(left) + int(self.body.shape.size.x) - 3, y
 
     def event_loop(self, e):
         if e.type == pygame.KEYDOWN:
             if e.key == pygame.K_SPACE:
-                self.hovering = True
-                if self.body.collide_down:
-                    self.jumping = True
-                    self.body.velocity.y += JUMP_IMPULSE
-                elif self.body.collide_left:
-                    self.jumping = False
-                    self.wall_jump = 1
-                    self.body.velocity = Pos(WALLJUMP_IMPULSE)
-                elif self.body.collide_right:
-                    self.jumping = False
-                    self.wall_jump = -1
-                    self.body.velocity = Pos(-WALLJUMP_IMPULSE[0], WALLJUMP_IMPULSE[1])
+                self.press_jump()
             elif e.key == pygame.K_w:
                 self.firing = True
                 self.fire_time = time()
-                self.building_fire = LightParticle(self.light_pos, range=15)
+                self.building_fire = self.particle_pool.acquire(self.light_pos, range=15)
             elif e.key == pygame.K_d:
                 self.raffale = True
             elif e.key == pygame.K_LEFT:
@@ -97,10 +181,7 @@ class Player:
 
         elif e.type == pygame.KEYUP:
             if e.key == pygame.K_SPACE:
-                self.jumping = False
-                self.hovering = False
-                self.wall_jump = 0
-                self.jump_frames = 0
+                self.release_jump()
             elif e.key == pygame.K_LEFT:
                 self.direction[0] = False
             elif e.key == pygame.K_RIGHT:
@@ -116,43 +197,15 @@ class Player:
     def update(self):
         self.light.center = self.light_pos
 
-        if self.direction[0] == self.direction[1]:
-            self.body.velocity.x = 0
-        elif self.direction[0]:
-            self.body.acceleration.x -= WALK_ACCELERATION
-            self.looking_left = True
-        elif self.direction[1]:
-            self.looking_left = False
-            self.body.acceleration.x += WALK_ACCELERATION
-
-        ay = 0
-        if self.jumping:
-            # we almost cancel gravity for the first frames and then less and less
-            ay = self.body.space.gravity.y * clamp(1 - self.jump_frames / JUMP_DURATION, 0, 1)
-            self.jump_frames += 1
-        elif self.wall_jump:
-            ay = self.body.space.gravity.y * clamp(1 - self.jump_frames / WALLJUMP_DURATION, 0, 1)
-            # self.body.acceleration.x += self.wall_jump * ay
-            self.jump_frames += 1
-        elif self.hovering:
-            # if we go down when hovering, we reduce the gravity
-            if self.body.velocity.y > 0:
-                ay += self.body.space.gravity.y * HOVERING_GRAVITY_FACTOR
-
-        # after a jump we want to quickly start going down for more control
-        # hovering but going up is not wanted
-        if not self.jumping and not self.wall_jump and self.body.velocity.y < 0:
-            self.body.velocity.y /= JUMP_BRAKE_STRENGTH
-
-        self.body.acceleration.y -= ay
+        self.update_movement()
 
         # Lights
         if self.raffale:
             if self.building_fire is None:
-                self.building_fire = LightParticle(self.light_pos, range=15)
+                self.building_fire = self.particle_pool.acquire(self.light_pos, range=15)
             elif self.building_fire.range > 40:
                 self.raffle_fire()
-                self.building_fire = LightParticle(self.light_pos, range=15)
+                self.building_fire = self.particle_pool.acquire(self.light_pos, range=15)
             else:
                 self.building_fire.range += 4
             self.building_fire.center = self.light_pos
@@ -161,46 +214,50 @@ class Player:
             self.building_fire.range = round(min(time() - self.fire_time, 1) * 50) + 10
             self.building_fire.center = self.light_pos
 
-        for l in self.lights[:]:
-            l.update()
-            if l.range < 3:
-                self.lights.remove(l)
-                self.body.space.moving_bodies.remove(l)
-
-
-
-        if False:
-            if time() - self.last_light_emit_time > LIGHT_EMIT_DELAY:
-                self.last_light_emit_time = time()
-                velocity = self.body.velocity + (random() - 1/2, random() - 1/2)
-                light = LightParticle(self.light_pos, velocity, life_time=LIGHT_LIFE_TIME)
-                self.lights.append(light)
-                self.body.space.add(light)
-            for l in self.lights[:]:
-                l.update()
-                if l.range < 2:
-                    self.lights.remove(l)
-                    l.space.moving_bodies.remove(l)
-                else:
-                    # add a spring between the light and the player
-                    spring_origin = self.light_pos + Pos(20, 0) * (2*self.looking_left - 1)  # 20 px behind player
-                    r = l.center - spring_origin
-                    v = l.velocity
-
-                    # -kr - bv  #physicsclass
-                    l.acceleration += -0.01 * r - 0.05 * v
+        self.particles.update(self.body.space)
+
     def get_rect(self):
         return self.body.shape.pygame_rect
 
-    def render(self, display: pygame.Surface):
-        display.blit(self.img, self.body.shape.topleft - self.sprite_offset)
+    def remember_position(self):
+        """Call this before each physics step, so render can interpolate."""
+        topleft = self.body.shape.topleft
+        self.previous_topleft = topleft.x, topleft.y
+
+    def interpolated_topleft(self, alpha):
+        """
+        :param alpha: how far we are between the last two updates. 0 is the previous one, 1 the last one.
+        """
+        x, y = self.body.shape.topleft
+        px, py = self.previous_topleft
+        return px + (x - px) * alpha, py + (y - py) * alpha
+
+    def place_lights(self, alpha=1.0):
+        """Put the lights where the player and the particles are drawn, see render."""
+        light_pos = self.light_pos_at(*self.interpolated_topleft(alpha))
+        self.light.center = light_pos
+        if self.building_fire is not None:
+            self.building_fire.center = light_pos
+        self.particles.place_lights(alpha)
+
+    def render(self, display: pygame.Surface, alpha=1.0):
+        """
+        :param alpha: how far we are between the last two updates. 0 is the previous one, 1 the last one.
+        """
+        x, y = self.interpolated_topleft(alpha)
+        display.blit(self.img, (x - self.sprite_offset[0], y - self.sprite_offset[1]))
         # display.set_at(approx(self.light_pos), rainbow)
 
     def get_rotated(self, angle: int) -> pygame.Surface:
         return pygame.transform.rotate(self.img, angle)
 
+    def lights_to_warm_up(self):
+        """The lights whose masks are worth computing before they are needed."""
+        # the fire balls are quadratic lights, their mask depend only on the range
+        return [self.light, *(Light((0, 0), range=r) for r in FIRE_BALL_RANGES)]
+
     def get_all_lights(self):
-        ret = [self.light, *self.lights]
+        ret = [self.light, *self.particles.lights]
         if self.building_fire:
             ret.append(self.building_fire)
         return ret
@@ -211,18 +268,18 @@ class Player:
 
         if not self.building_fire.velocity:
             vx = self.body.velocity.x - 10*(self.looking_left * 2 - 1)
-            self.building_fire.velocity = Pos(vx, random() / 5 - 0.1)
+            self.building_fire.velocity.set(vx, random() / 5 - 0.1)
         if not self.building_fire.life_time:
             self.building_fire.life_time = self.building_fire.range / 30
-        self.lights.append(self.building_fire)
-        self.body.space.add(self.building_fire)
+        self.particles.emit_particle(self.building_fire)
+        self.particle_pool.release(self.building_fire)
         self.building_fire = None
 
     def raffle_fire(self):
         if not self.building_fire:
             return
         vx = -6 * (2 * self.looking_left - 1), 3*random() - 2
-        self.building_fire.velocity = self.body.velocity + vx
+        self.building_fire.velocity.set(self.body.velocity.x + vx[0], self.body.velocity.y + vx[1])
         self.building_fire.life_time = 0.4
         self.fire()
 
@@ -0,0 +1,108 @@
+"""
+Put the small game surface on the screen.
+
+The game is drawn on a small surface that is scaled up to the screen.
+SoftwarePresenter does it with pygame.transform.scale on the CPU, which gets slow
+with big screens. RendererPresenter uploads the small surface to a texture once per frame
+and lets SDL scale it, on the GPU when there is one.
+
+Both give a `hud` surface to draw what goes on top of the game, at the screen resolution.
+"""
+
+import os
+
+import pygame
+
+from profiler import profiler
+
+
+class SoftwarePresenter:
+    """Scale the game on the display surface, with the CPU."""
+
+    name = "software"
+
+    def __init__(self, screen_size):
+        self.screen_size = screen_size
+        self.display = pygame.display.set_mode(screen_size)  # type: pygame.Surface
+
+    def show(self, game_surf):
+        """
+        Scale the game to the screen.
+
+        :return: the surface where the hud is drawn, before calling present
+        """
+
+        # we scale our mini surface to the real one, with the nearest pixel (we don't want to blur)
+        with profiler.section("scale"):
+            pygame.transform.scale(game_surf, self.screen_size, self.display)
+        return self.display
+
+    def present(self):
+        with profiler.section("present"):
+            pygame.display.update()
+
+    def close(self):
+        pass
+
+
+class RendererPresenter:
+    """Upload the game to a texture and let SDL scale it, on the GPU if there is one."""
+
+    name = "renderer"
+
+    def __init__(self, screen_size, game_size, title="Shadows", hud_size=(640, 480), vsync=False):
+        """
+        :param hud_size: size of the hud surface, in the topleft of the screen.
+            It is uploaded every frame, so it is better to keep it small.
+        """
+
+        # imported here, as it is not in every version of pygame
+        from pygame._sdl2.video import Window, Renderer, Texture
+
+        # nearest pixel for the scaling, the pixel art should stay sharp
+        os.environ.setdefault("SDL_RENDER_SCALE_QUALITY", "nearest")
+
+        self.screen_size = screen_size
+        # Surface.convert() needs a display mode, but we don't draw on it
+        pygame.display.set_mode((1, 1), pygame.HIDDEN)
+        self.window = Window(title, size=screen_size)
+        self.renderer = Renderer(self.window, vsync=vsync)
+        self.game_texture = Texture(self.renderer, game_size, streaming=True)
+
+        hud_size = min(hud_size[0], screen_size[0]), min(hud_size[1], screen_size[1])
+        self.hud = pygame.Surface(hud_size, pygame.SRCALPHA)
+        self.hud_texture = Texture(self.renderer, hud_size, streaming=True)
+        self.hud_texture.blend_mode = 1  # SDL_BLENDMODE_BLEND
+
+    def show(self, game_surf):
+        with profiler.section("scale"):
+            self.game_texture.update(game_surf)
+        self.hud.fill((0, 0, 0, 0))
+        return self.hud
+
+    def present(self):
+        with profiler.section("present"):
+            self.hud_texture.update(self.hud)
+            self.renderer.clear()
+            # without a destination, the texture is stretched on the whole window
+            self.renderer.blit(self.game_texture)
+            self.renderer.blit(self.hud_texture, self.hud.get_rect())
+            self.renderer.present()
+
+    def close(self):
+        self.window.destroy()
+
+
+def create_presenter(kind, screen_size, game_size):
+    """
+    :param kind: "renderer", "software", or "auto" to use the renderer when it works
+    """
+
+    if kind in ("renderer", "auto"):
+        try:
+            return RendererPresenter(screen_size, game_size)
+        except (ImportError, pygame.error) as e:
+            if kind == "renderer":
+                raise
+            print(f"Can't use the SDL renderer ({e}), scaling in software instead.")
+    return SoftwarePresenter(screen_size)
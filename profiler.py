@@ -0,0 +1,258 @@
+"""
+Named timing sections, to know where the time of a frame goes.
+
+    from profiler import profiler
+
+    with profiler.section("blur"):
+        ...
+
+    times = profiler.end_frame()  # {"blur": 0.0021, ...} in seconds
+
+The sections cost almost nothing while the profiler is disabled,
+so they can stay in the hot paths.
+The last frames are kept in ring buffers, that the TimingOverlay draws in debug mode.
+If the profiler has a tracer (see telemetry.py), every section is also recorded as a span.
+
+The sections of other threads are not on the path of the frame, so they shouldn't add up
+with the ones of the main thread. A thread can record its sections under its own names:
+
+    profiler.name_thread("worker ")  # "blur" is now "worker blur" in this thread
+"""
+
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+from time import perf_counter
+
+import numpy as np
+import pygame
+
+_DISABLED = nullcontext()
+
+
+class RingBuffer:
+    """The last `size` values pushed, in a numpy array."""
+
+    def __init__(self, size):
+        self.data = np.zeros(size)
+        self.index = 0  # where the next value goes
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, value):
+        self.data[self.index] = value
+        self.index = (self.index + 1) % len(self.data)
+        if self.count < len(self.data):
+            self.count += 1
+
+    def values(self):
+        """The values, oldest first."""
+        if self.count < len(self.data):
+            return self.data[:self.count]
+        return np.roll(self.data, -self.index)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        # the order doesn't matter here
+        return float(np.percentile(self.data[:self.count], q))
+
+
+class _Section:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        stack = profiler.open
+        if stack:
+            profiler.parents[self.name] = stack[-1]
+        stack.append(self.name)
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        end = perf_counter()
+        profiler = self.profiler
+        profiler.times[self.name] += end - self.start
+        profiler.open.pop()
+        if profiler.tracer is not None:
+            profiler.tracer.span(self.name, self.start, end)
+
+
+class Profiler:
+    def __init__(self, enabled=False, history=240):
+        """
+        :param history: number of frames kept in the ring buffers
+        """
+
+        self.enabled = enabled
+        self.tracer = None  # type: telemetry.Tracer
+        # time spent in each section since the last end_frame
+        self.times = defaultdict(float)
+        # the sections we are in (per thread), and in which section each one was last time
+        self._local = threading.local()
+        self.parents = {}
+        # the names of the sections recorded by threads with a prefix (see name_thread)
+        self.background = set()
+
+        self.history_size = history
+        # last frames of each section, and the total time between end_frame calls as 'frame'
+        self.history = {}  # type: dict[str, RingBuffer]
+        self.frames = 0
+        self._last_end = None
+
+    @property
+    def open(self):
+        try:
+            return self._local.open
+        except AttributeError:
+            self._local.open = []
+            return self._local.open
+
+    def section(self, name):
+        """Context manager that adds the time spent inside to the section `name`."""
+        if not self.enabled:
+            return _DISABLED
+        prefix = getattr(self._local, 'prefix', None)
+        if prefix is not None:
+            name = prefix + name
+            self.background.add(name)
+        return _Section(self, name)
+
+    def name_thread(self, prefix):
+        """From now on, the sections of the calling thread are recorded as prefix + name."""
+        self._local.prefix = prefix
+
+    def end_frame(self):
+        """Return the time spent in each section since the last call, in seconds."""
+
+        # swapped and not cleared, other threads may be adding their sections to it
+        times, self.times = self.times, defaultdict(float)
+        times = dict(times)
+
+        now = perf_counter()
+        if self._last_end is not None:
+            times.setdefault('frame', now - self._last_end)
+        self._last_end = now
+
+        if self.history_size:
+            self._push(times)
+
+        return times
+
+    def _push(self, times):
+        for name in times:
+            if name not in self.history:
+                # sections that appear late had a time of 0 before, so all buffers are aligned
+                buffer = RingBuffer(self.history_size)
+                for _ in range(min(self.frames, self.history_size)):
+                    buffer.push(0)
+                self.history[name] = buffer
+
+        for name, buffer in self.history.items():
+            buffer.push(times.get(name, 0))
+        self.frames += 1
+
+    def exclusive(self, name):
+        """The history of a section, without the time spent in its sub-sections."""
+        values = self.history[name].values().copy()
+        for child, parent in self.parents.items():
+            if parent == name and child in self.history:
+                values -= self.history[child].values()
+        return values
+
+    def reset(self):
+        self.times.clear()
+        self.history.clear()
+        self.frames = 0
+        self._last_end = None
+
+
+# The one used by the game
+profiler = Profiler()
+
+
+class TimingOverlay:
+    """Stacked bars of the time of each section for the last frames, with their rolling percentiles."""
+
+    COLORS = [(230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48),
+              (145, 30, 180), (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 190)]
+
+    def __init__(self, profiler=profiler, frames=120, bar_width=3, px_per_ms=6, budget=1000 / 60, legend_every=30):
+        """
+        :param frames: number of frames shown
+        :param budget: time of a frame we aim for, in ms. A line is drawn at this height.
+        :param legend_every: the percentiles are computed again only every that many frames
+        """
+
+        self.profiler = profiler
+        self.frames = frames
+        self.bar_width = bar_width
+        self.px_per_ms = px_per_ms
+        self.budget = budget
+        self.legend_every = legend_every
+        self.colors = {}
+        self.font = pygame.font.Font(None, 20)
+        self._legend = None  # type: pygame.Surface
+        self._legend_frame = None
+
+    def color(self, name):
+        if name not in self.colors:
+            self.colors[name] = self.COLORS[len(self.colors) % len(self.COLORS)]
+        return self.colors[name]
+
+    def render(self, surf, pos=(20, 60)):
+        history = self.profiler.history
+        # the sections of the other threads are not stacked, they are not part of the frame time
+        names = [name for name in history if name != 'frame' and name not in self.profiler.background]
+        if not names:
+            return
+        colors = [self.color(name) for name in names]
+
+        x, y = pos
+        width = self.frames * self.bar_width
+        height = round(2 * self.budget * self.px_per_ms)
+        bottom = y + height
+        surf.fill((0, 0, 0), (x, y, width, height))
+
+        # one bar per frame, with a stacked segment per section
+        scale = 1000 * self.px_per_ms
+        tops = None
+        for name, color in zip(names, colors):
+            heights = self.profiler.exclusive(name)[-self.frames:] * scale
+            if tops is None:
+                tops = np.full(len(heights), bottom, dtype=float)
+            for i, (top, h) in enumerate(zip(tops.tolist(), heights.tolist())):
+                if h >= 1:
+                    surf.fill(color, (x + i * self.bar_width, max(round(top - h), y), self.bar_width, round(h)))
+            tops -= np.maximum(heights, 0)
+
+        budget_y = bottom - round(self.budget * self.px_per_ms)
+        pygame.draw.line(surf, (255, 255, 255), (x, budget_y), (x + width, budget_y))
+
+        frames = self.profiler.frames
+        if self._legend is None or not 0 <= frames - self._legend_frame < self.legend_every:
+            self._legend = self.render_legend(names + sorted(self.profiler.background & history.keys()))
+            self._legend_frame = frames
+        surf.blit(self._legend, (x, bottom + 4))
+
+    def render_legend(self, names):
+        history = self.profiler.history
+        lines = [(name, self.color(name)) for name in names]
+        if 'frame' in history:
+            lines.append(('frame', (255, 255, 255)))
+
+        line_height = self.font.get_linesize()
+        legend = pygame.Surface((self.frames * self.bar_width, line_height * len(lines)))
+        for i, (name, color) in enumerate(lines):
+            buffer = history[name]
+            legend.blit(self.font.render(name, True, color), (0, i * line_height))
+            for j, q in enumerate((50, 95)):
+                text = f"p{q} {1000 * buffer.percentile(q):.2f} ms"
+                legend.blit(self.font.render(text, True, color), (110 + 120 * j, i * line_height))
+        return legend
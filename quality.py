@@ -0,0 +1,105 @@
+"""
+Adapt the quality of the lights to keep the frame rate.
+
+The governor measures how long the last frames took and moves along a ladder of quality
+levels: down when the frames are over budget, up when there is plenty of time left.
+The thresholds are far apart and it waits a bit after each change, so it doesn't oscillate.
+When going up was a mistake, it waits twice longer before trying again.
+"""
+
+from collections import namedtuple
+
+from profiler import RingBuffer
+
+QualityLevel = namedtuple("QualityLevel", "name light_every variant_every blur resolution shadows")
+QualityLevel.__doc__ = """
+:param light_every: the light masks are computed again every that many frames
+:param variant_every: the lights change variant every that many frames
+:param blur: size of the blur of the global mask, 0 for none
+:param resolution: the global mask is blurred at 1/resolution of the game size
+:param shadows: False to not compute lights at all
+"""
+
+# From the best to the worst
+LEVELS = [
+    QualityLevel("ultra", 1, 6, 10, 1, True),
+    QualityLevel("high", 2, 6, 10, 1, True),
+    QualityLevel("medium", 3, 8, 8, 2, True),
+    QualityLevel("low", 4, 12, 6, 2, True),
+    QualityLevel("lowest", 6, 12, 4, 4, True),
+    QualityLevel("no shadows", 6, 12, 0, 4, False),
+]
+DEFAULT_LEVEL = 1
+
+
+class QualityGovernor:
+    def __init__(self, target=1000 / 60, levels=LEVELS, level=DEFAULT_LEVEL, window=60,
+                 down_above=1.0, up_below=0.6, cooldown=120):
+        """
+        :param target: the frame time we want, in ms
+        :param window: number of frames looked at to decide
+        :param down_above: go down a level when the 90th percentile of the frames is above target * down_above
+        :param up_below: and up when it is below target * up_below
+        :param cooldown: frames to wait after a change before deciding anything again
+        """
+
+        self.target = target
+        self.levels = levels
+        self.level = level
+        self.down_above = down_above
+        self.up_below = up_below
+        self.cooldown = cooldown
+
+        self.frame_times = RingBuffer(window)
+        self.wait = cooldown
+        self.up_cooldown = cooldown  # frames to wait before going up after going down
+        self.up_wait = 0
+        self.went_up = False
+
+    @property
+    def current(self) -> QualityLevel:
+        return self.levels[self.level]
+
+    def frame(self, ms):
+        """
+        Tell how long the last frame took to compute, in ms.
+
+        :return: True if the level changed
+        """
+
+        self.frame_times.push(ms)
+        if self.up_wait > 0:
+            self.up_wait -= 1
+        if self.wait > 0:
+            self.wait -= 1
+            return False
+        if len(self.frame_times) < len(self.frame_times.data):
+            return False
+
+        slow = self.frame_times.percentile(90)
+        if slow > self.target * self.down_above and self.level < len(self.levels) - 1:
+            if self.went_up:
+                # we just came from there, it was too slow
+                self.up_cooldown *= 2
+            self.went_up = False
+            self.up_wait = self.up_cooldown
+            self.set_level(self.level + 1)
+            return True
+
+        if self.went_up:
+            # a whole window at the level we went up to, and it's fine
+            self.went_up = False
+            self.up_cooldown = self.cooldown
+
+        if slow < self.target * self.up_below and self.level > 0 and self.up_wait <= 0:
+            self.went_up = True
+            self.set_level(self.level - 1)
+            return True
+
+        return False
+
+    def set_level(self, level):
+        self.level = level
+        # the frames before don't tell anything about this level
+        self.frame_times = RingBuffer(len(self.frame_times.data))
+        self.wait = self.cooldown
@@ -0,0 +1,88 @@
+"""
+Record the inputs of a session and play them again.
+
+The inputs are saved for each update tick, with the seed of the random generators.
+The game clock advances of a fixed step at each tick in both modes, so a replay
+goes exactly like the recorded session, frame for frame.
+This makes it a fixed workload for profiling:
+
+    python . --record session.json
+    python . --replay session.json
+    python bench_app.py --replay session.json
+"""
+
+import json
+import random
+
+import numpy as np
+import pygame
+
+import gameclock
+
+VERSION = 1
+# The only events the game uses, the rest (window events...) is not recorded
+RECORDED_EVENTS = {pygame.KEYDOWN, pygame.KEYUP, pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP}
+
+
+def start_session(seed, update_fps):
+    """Put the random generators and the game clock in the same state for recording and replaying."""
+    random.seed(seed)
+    np.random.seed(seed)
+    gameclock.clock.use_fixed_step(1 / update_fps)
+
+
+def encode_event(event):
+    # window is None for keys, and not useful anyway
+    attrs = {k: v for k, v in event.dict.items() if isinstance(v, (int, float, str, tuple)) and k != 'window'}
+    return [event.type, attrs]
+
+
+def decode_event(data):
+    type_, attrs = data
+    attrs = {k: tuple(v) if isinstance(v, list) else v for k, v in attrs.items()}
+    return pygame.event.Event(type_, attrs)
+
+
+class Recorder:
+    def __init__(self, path, seed=0, update_fps=60):
+        self.path = path
+        self.seed = seed
+        self.update_fps = update_fps
+        self.ticks = {}  # tick -> list of encoded events
+        self.last_tick = 0
+        start_session(seed, update_fps)
+
+    def record(self, tick, events):
+        encoded = [encode_event(e) for e in events if e.type in RECORDED_EVENTS]
+        if encoded:
+            self.ticks[tick] = encoded
+        self.last_tick = tick
+
+    def save(self):
+        data = dict(version=VERSION, seed=self.seed, update_fps=self.update_fps, last_tick=self.last_tick,
+                    ticks={str(tick): events for tick, events in self.ticks.items()})
+        with open(self.path, "w") as f:
+            json.dump(data, f)
+
+
+class Replayer:
+    def __init__(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data["version"] > VERSION:
+            raise ValueError(f"{path} is a recording of version {data['version']}, "
+                             f"but only up to {VERSION} is supported")
+
+        self.path = path
+        self.seed = data["seed"]
+        self.update_fps = data["update_fps"]
+        self.last_tick = data["last_tick"]
+        self.ticks = {int(tick): events for tick, events in data["ticks"].items()}
+        start_session(self.seed, self.update_fps)
+
+    def events(self, tick):
+        """The events that happened during this tick."""
+        return [decode_event(e) for e in self.ticks.get(tick, ())]
+
+    def done(self, tick):
+        return tick > self.last_tick
@@ -1,30 +1,48 @@
 #!/usr/bin/env python3
 
+import argparse
 import os
 from colorsys import hsv_to_rgb
 from functools import lru_cache
 from random import random
+from time import perf_counter, strftime
 
 import pygame
-from graphalama.text import SimpleText
 from visibility import VisibiltyCalculator
 
-from apple import TileMap
-from light import GlobalLightMask, RainbowLight
+import gameclock
+from capture import FrameCapture, FrameRecorder
+from light import GlobalLightMask, RainbowLight, ThreadedLightMask, MaskWarmUp
 from maths import segments, Pos
-from physics import Space, AABB
+from physics import Space
 from player import Player
+from present import create_presenter
+from profiler import profiler, TimingOverlay
+from quality import QualityGovernor, DEFAULT_LEVEL
+from replay import Recorder, Replayer
+from telemetry import Tracer
+from tilemap import TileMap
 
 pygame.init()
 
 BLOCK_SIZE = 16
-SCREEN_SIZE = pygame.display.list_modes()[0]
 GAME_SIZE = (480, 270)
 SKY_COLOR = (255, 255, 255)
 SHADOW_POLY_EXTEND = 5
 GRAVITY = (0, 0.2)
 
 
+def default_screen_size():
+    """The biggest resolution of the screen, or 4 times the game size if we can't know it."""
+    modes = pygame.display.list_modes()
+    if modes == -1 or not modes:
+        return GAME_SIZE[0] * 4, GAME_SIZE[1] * 4
+    return modes[0]
+
+
+SCREEN_SIZE = default_screen_size()
+
+
 def random_color():
     """Return a randomly chosen color, with max brightness and saturation."""
     hue = random()
@@ -45,27 +63,54 @@ def random_cached_color(*args):
 class App:
     UPDATE_FPS = 60
     FPS = 600
+    # Time we want a frame to take at most, in ms. It doesn't depend on UPDATE_FPS,
+    # the frames are drawn (and interpolated) even when the updates are less frequent
+    FRAME_BUDGET = 1000 / 60
+    # After a slow frame, we don't do more updates than that to catch up,
+    # otherwise the next frame is even slower, and so on
+    MAX_UPDATES_PER_FRAME = 5
 
     # Feature flags
     ENABLE_SHADOW = True  # [s] to toggle shadows
     MOUSE_CONTROL = False  # [m] so the player follow the mouse
     DEBUG = False  # [d] to maybe discover bugs
-
-    def __init__(self):
-        self.display = pygame.display.set_mode(SCREEN_SIZE)  # type: pygame.Surface
+    ADAPTIVE_QUALITY = True  # [q] lower the quality of the lights when the frames are too slow
+    THREADED_LIGHTS = (os.cpu_count() or 1) > 1  # compute the lights in a worker thread, one update late
+    PRESENTER = "software"  # how the game is scaled to the screen, "renderer" to let SDL do it (see present.py)
+    CAPTURE_FPS = 30  # [v] rate of the frames saved when recording them
+
+    def __init__(self, screen_size=SCREEN_SIZE, record=None, replay=None, presenter=None):
+        """
+        :param record: file where the inputs of the session are saved
+        :param replay: file of recorded inputs to play again, instead of the live ones
+        :param presenter: "software", "renderer" or "auto", default to App.PRESENTER
+        """
+
+        # Before anything uses the game clock or random numbers
+        self.recorder = Recorder(record, update_fps=self.UPDATE_FPS) if record else None
+        self.replayer = Replayer(replay) if replay else None
+
+        self.screen_size = screen_size
+        self.presenter = create_presenter(presenter or self.PRESENTER, screen_size, GAME_SIZE)
         # Everything is made on a small surface, that is then scaled to the display resolution
         # There two reasons:
         #   - Get the pixel "art" look
         #   - Performance, as I can't blur efficiently a huge surface, and the cool look of the lights
         #       comes from the blur
         self.back_screen = pygame.Surface(GAME_SIZE)
+        # screenshots and recordings are saved in the background (see capture.py)
+        self.capture = FrameCapture(GAME_SIZE)
+        self.frame_recorder = None  # type: FrameRecorder
         self.clock = pygame.time.Clock()
         self.frame = 0
+        self.dropped_updates = 0  # updates skipped because we were too late
         self.stop = False
+        self.mouse_pos = (0, 0)
 
         # Environment
         self.map = TileMap.load('assets/levels/0')
-        self.walls = self.map.collision_rects()
+        # the tile sets are decoded while the rest is set up
+        self.map.preload()
 
         # Physics
         self.player = Player()
@@ -73,39 +118,110 @@ class App:
 
         # Lights
         self.shadow_caster = VisibiltyCalculator(self.create_shadow_walls(GAME_SIZE))
-        lights = [self.player.light]  # , *self.gen_lights()]
-        self.light_mask = GlobalLightMask(lights, GAME_SIZE, self.shadow_caster, (30, 30, 30))
+        lights = [self.player.light]
+        # the lights of the level, [l] to toggle them
+        self.static_lights = []
+        mask_class = ThreadedLightMask if self.THREADED_LIGHTS else GlobalLightMask
+        self.light_mask = mask_class(lights, GAME_SIZE, self.shadow_caster, (30, 30, 30))
+        self.quality = QualityGovernor(self.FRAME_BUDGET)
+        self.apply_quality()
+        # while the first frames are drawn
+        self.warm_up = MaskWarmUp([*self.player.lights_to_warm_up(), *self.gen_lights()])
+        self.warm_up.start()
 
         # UI
-        self.fps_text = SimpleText("Be love", (20, 20), color=(255, 180, 180))
+        self.fps_text = None  # created after the first frame, see update_fps_text
+        self.timings = None  # type: TimingOverlay
         self.bg = pygame.image.load("assets/bg.gif").convert()  # type: pygame.Surface
         self.bg.fill((50,)*3, None, pygame.BLEND_RGB_ADD)
 
     def run(self):
         accu = 0
         while not self.stop:
+            frame_start = perf_counter()
 
             # Updating
-            while accu > 1000 / self.UPDATE_FPS:
+            step = 1000 / self.UPDATE_FPS
+            updates = 0
+            while accu > step:
                 # We want to get that stable 60 fps update whatever the rendering takes
-                accu -= 1000 / self.UPDATE_FPS
-                self.frame += 1
-                self.event_loop()
-                self.update()
-
-            # Rendering is done in two steps
-            # First we render our game as we would usualy do, on the back_screen surface
-            self.render(self.back_screen)
-            # But then we apply the shadows on back_screen and put the result (scaled) on the display
-            self.do_shadow()
-            # on top of everything else
-            self.fps_text.render(self.display)
-
-            pygame.display.update()
+                if updates == self.MAX_UPDATES_PER_FRAME:
+                    # but we can't catch up, better slow the game down than freeze it
+                    dropped = int(accu // step)
+                    self.dropped_updates += dropped
+                    accu -= dropped * step
+                    break
+                accu -= step
+                self.tick()
+                updates += 1
+
+            # we are somewhere between the last update and the next one
+            self.draw(accu / step)
+            if self.ADAPTIVE_QUALITY and self.quality.frame(1000 * (perf_counter() - frame_start)):
+                self.apply_quality()
+            if profiler.enabled:
+                profiler.end_frame()
+            if profiler.tracer is not None:
+                profiler.tracer.span("frame", frame_start, perf_counter(), "frame", frame=self.frame,
+                                     updates=updates, dropped=self.dropped_updates)
 
             # FPS
             accu += self.clock.tick(self.FPS)
-            self.fps_text.text = f"FPS: {round(self.clock.get_fps())}"
+            self.update_fps_text()
+
+        if profiler.tracer is not None:
+            self.toggle_trace()
+        if self.frame_recorder is not None:
+            self.toggle_frame_recording()
+        self.capture.close()
+        self.light_mask.close()
+        self.presenter.close()
+        if self.recorder is not None:
+            self.recorder.save()
+            print(f"\033[32mInputs saved at '{os.path.abspath(self.recorder.path)}'.\033[m")
+
+    def tick(self):
+        """One update of the game: events, physics and everything."""
+        with profiler.section("update"):
+            self.frame += 1
+            gameclock.clock.tick()
+            self.event_loop()
+            self.update()
+
+    def draw(self, alpha=1.0):
+        """
+        :param alpha: time since the last update, as a fraction of the time between updates.
+            Moving things are drawn this far between their previous and their last position.
+        """
+
+        # Rendering is done in two steps
+        # First we render our game as we would usualy do, on the back_screen surface
+        with profiler.section("render"):
+            self.render(self.back_screen, alpha)
+        # But then we apply the shadows on back_screen and put the result (scaled) on the display
+        # with the lights where the things that emit them are drawn
+        self.player.place_lights(alpha)
+        self.do_shadow()
+        if self.frame_recorder is not None:
+            self.frame_recorder.frame_ready(self.back_screen, perf_counter())
+        hud = self.presenter.show(self.back_screen)
+        # on top of everything else
+        if self.fps_text is not None:
+            self.fps_text.render(hud)
+        if self.DEBUG:
+            self.timings.render(hud)
+
+        self.presenter.present()
+
+    def update_fps_text(self):
+        if self.fps_text is None:
+            # graphalama is imported only once the first frame is shown, it takes a while
+            from graphalama.text import SimpleText
+            self.fps_text = SimpleText("Be love", (20, 20), color=(255, 180, 180))
+
+        self.fps_text.text = f"FPS: {round(self.clock.get_fps())}"
+        if self.DEBUG:
+            self.fps_text.text += f" - quality: {self.quality.current.name} - dropped: {self.dropped_updates}"
 
     def event_loop(self):
 
@@ -113,46 +229,116 @@ class App:
         #   - [Esq] Quit
         #   - [s]   Toggle shadows
         #   - [p]   Screenshot
+        #   - [v]   Start/stop saving the frames
         #   - [m]   Player follow mouse
-        #   - [l]   Re-generate lights
-        #   - [d]   Toggle debug mode
+        #   - [l]   Toggle the lights of the level
+        #   - [d]   Toggle debug mode (and the timings overlay)
+        #   - [t]   Start/stop recording a trace of the frames
+        #   - [q]   Toggle adaptive quality
 
-        for e in pygame.event.get():
+        for e in self.events():
             if e.type == pygame.QUIT:
                 self.stop = True
+            if e.type == pygame.MOUSEMOTION:
+                self.mouse_pos = e.pos
             if e.type == pygame.KEYDOWN:
                 if e.key == pygame.K_ESCAPE:
                     self.stop = True
                 elif e.key == pygame.K_s:
                     self.ENABLE_SHADOW = not self.ENABLE_SHADOW
                 elif e.key == pygame.K_p:
-                    pygame.image.save(self.display, "shadows.png")
-                    print(f"\033[32mScreenshot saved at '{os.path.abspath('screenshots/shadows.png')}'.\033[m")
+                    path = strftime("screenshots/shadows-%Y-%m-%d-%H-%M-%S.png")
+                    # the last frame, at the resolution of the game: it fits in the buffers of the capture
+                    # and doesn't need a copy of the whole display
+                    if self.capture.grab(self.back_screen, path):
+                        print(f"\033[32mScreenshot saved at '{os.path.abspath(path)}'.\033[m")
+                elif e.key == pygame.K_v:
+                    self.toggle_frame_recording()
                 elif e.key == pygame.K_m:
                     self.MOUSE_CONTROL = not self.MOUSE_CONTROL
                 elif e.key == pygame.K_l:
-                    if len(self.light_mask.lights) == 1:
-                        lights = [self.player.light, *self.gen_lights()]
-                    else:
-                        lights = [self.player.light]
-                    self.light_mask.lights = lights
+                    self.static_lights = [] if self.static_lights else self.gen_lights()
                 elif e.key == pygame.K_d:
-                    self.DEBUG = not self.DEBUG
+                    self.toggle_debug()
+                elif e.key == pygame.K_t:
+                    self.toggle_trace()
+                elif e.key == pygame.K_q:
+                    self.ADAPTIVE_QUALITY = not self.ADAPTIVE_QUALITY
+                    if not self.ADAPTIVE_QUALITY:
+                        self.quality.set_level(DEFAULT_LEVEL)
+                        self.apply_quality()
             self.player.event_loop(e)
 
+    def events(self):
+        """The events of this tick: the live ones, or the recorded ones in a replay."""
+
+        events = pygame.event.get()
+
+        if self.replayer is not None:
+            # we still listen to the live events to quit
+            live = [e for e in events if e.type == pygame.QUIT
+                    or e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE]
+            events = live + self.replayer.events(self.frame)
+            if self.replayer.done(self.frame):
+                self.stop = True
+        elif self.recorder is not None:
+            self.recorder.record(self.frame, events)
+
+        return events
+
+    def apply_quality(self):
+        """Use the knobs of the current quality level."""
+        level = self.quality.current
+        self.light_mask.blur = level.blur
+        self.light_mask.resolution = level.resolution
+
+    def toggle_debug(self):
+        """Debug mode also shows how long each part of a frame takes."""
+        self.DEBUG = not self.DEBUG
+        profiler.enabled = self.DEBUG or profiler.tracer is not None
+        profiler.reset()
+        if self.timings is None:
+            self.timings = TimingOverlay(profiler, budget=self.FRAME_BUDGET)
+
+    def toggle_trace(self):
+        """Start or stop recording the frames, the sections and the lights in traces/."""
+        if profiler.tracer is None:
+            path = strftime("traces/trace-%Y-%m-%d-%H-%M-%S.json")
+            profiler.tracer = Tracer(path)
+            profiler.enabled = True
+            print(f"Recording a trace in '{os.path.abspath(path)}'.")
+        else:
+            profiler.tracer.close()
+            print(f"\033[32mTrace saved at '{os.path.abspath(profiler.tracer.path)}'.\033[m")
+            profiler.tracer = None
+            profiler.enabled = self.DEBUG
+
+    def toggle_frame_recording(self):
+        """Start or stop saving the frames (without the hud) in recordings/."""
+        if self.frame_recorder is None:
+            directory = strftime("recordings/%Y-%m-%d-%H-%M-%S")
+            self.frame_recorder = FrameRecorder(self.capture, directory, self.CAPTURE_FPS)
+            print(f"Saving the frames in '{os.path.abspath(directory)}'.")
+        else:
+            recorder = self.frame_recorder
+            print(f"\033[32m{recorder.frame - recorder.dropped} frames saved in '{os.path.abspath(recorder.directory)}'"
+                  f" ({recorder.dropped} dropped).\033[m")
+            self.frame_recorder = None
+
     def update(self):
         # Apply gravity / collisions and stuff
+        self.player.remember_position()
         self.space.simulate()
 
         if self.MOUSE_CONTROL:
-            self.player.body.shape.center = Pos(pygame.mouse.get_pos()) // 4
+            self.player.body.shape.center = Pos(self.mouse_pos) // 4
 
         # Update light position, update from input etc for next frame
         # This should be before space.simulate, but I need to put it after the MOUSE_CONTROL
         # Otherwise the player is moved and is not on the mouse
         self.player.update()
 
-    def render(self, surf):
+    def render(self, surf, alpha=1.0):
         surf.fill(SKY_COLOR)
         # surf.blit(self.bg, (0, 0))
 
@@ -160,7 +346,7 @@ class App:
         self.map.render(surf)
 
         # Player
-        self.player.render(surf)
+        self.player.render(surf, alpha)
 
         if self.DEBUG and not self.ENABLE_SHADOW:
             # segments that block the light
@@ -171,12 +357,11 @@ class App:
     def do_shadow(self):
         # It is not really the main part of the shadow, the interesting stuff is in light.py and vfx.py
 
-        if self.ENABLE_SHADOW:
-            self.update_light_mask()
-            self.light_mask.apply_light_on(self.back_screen)
-
-        # we scale our mini surface to the real one, with the nearest pixel (we don't want to blur
-        pygame.transform.scale(self.back_screen, SCREEN_SIZE, self.display)
+        if self.ENABLE_SHADOW and self.quality.current.shadows:
+            with profiler.section("light update"):
+                self.update_light_mask()
+            with profiler.section("apply light"):
+                self.light_mask.apply_light_on(self.back_screen)
 
     def create_shadow_walls(self, screensize):
         walls = self.map.light_blockers()
@@ -190,23 +375,24 @@ class App:
 
         space = Space(GRAVITY)
 
-        # TODO: use the tilemap for collision instead
-        for rect in self.walls:
-            p = AABB(rect.topleft, rect.size)
-            space.add(p)
-
+        space.add(self.map.collider())
         space.add(self.player.body)
 
         return space
 
     def update_light_mask(self):
-        # We update the light masks every second frame, there is no need to do it more often
-        # as it means more computation for very noticeable change
-        if self.frame % 2 == 0:
-            self.light_mask.lights = self.player.get_all_lights()
+        if not self.warm_up.first_done.is_set():
+            # we would wait for scipy and the player's mask, better show only the ambient light for now
+            return
+
+        quality = self.quality.current
+        # We update the light masks every second frame (depending on the quality), there is no need
+        # to do it more often as it means more computation for very noticeable change
+        if self.frame % quality.light_every == 0:
+            self.light_mask.lights = [*self.player.get_all_lights(), *self.static_lights]
             self.light_mask.update_mask()
         # Every 6 frames we cycle through the variants, so the edge of the lights appear wiggling (?) like a fire
-        if self.frame % 6 == 0:
+        if self.frame % quality.variant_every == 0:
             for l in self.light_mask.lights:
                 l.next_variant()
 
@@ -223,5 +409,16 @@ class App:
         return lights
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Shadows and lights with pygame.")
+    parser.add_argument("--record", metavar="FILE", help="save the inputs of the session in this file")
+    parser.add_argument("--replay", metavar="FILE", help="play again the inputs recorded in this file")
+    parser.add_argument("--present", choices=("software", "renderer", "auto"), default=App.PRESENTER,
+                        help="scale the game in software, or with the SDL renderer (default: %(default)s)")
+    args = parser.parse_args()
+
+    App(record=args.record, replay=args.replay, presenter=args.present).run()
+
+
 if __name__ == '__main__':
-    App().run()
+    main()
@@ -0,0 +1,99 @@
+"""
+Record what happens in each frame to a file, to analyse stutters offline.
+
+The spans are saved in the Chrome Trace Event format (open the file in chrome://tracing
+or https://ui.perfetto.dev) or as JSON lines if the file ends with .jsonl.
+Recording only appends a tuple to a deque, a background thread formats and writes them,
+so the game never waits for the disk.
+"""
+
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter
+
+
+class Tracer:
+    def __init__(self, path, flush_every=0.5):
+        """
+        :param path: where to save the trace. JSON lines if it ends with .jsonl, Chrome trace otherwise.
+        :param flush_every: seconds between two writes
+        """
+
+        self.path = path
+        self.jsonl = path.endswith(".jsonl")
+        self.flush_every = flush_every
+        self.origin = perf_counter()
+
+        # (name, category, start, end, thread, args). Deques are thread safe, so no lock is needed.
+        self.events = deque()
+        self.thread_names = {threading.get_ident(): threading.current_thread().name}
+        self._first = True
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "w")
+        if not self.jsonl:
+            self.file.write("[\n")
+
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="trace writer", daemon=True)
+        self._writer.start()
+
+    def span(self, name, start, end, category="stage", **args):
+        """Record that `name` took place between start and end (from perf_counter)."""
+        thread = threading.get_ident()
+        if thread not in self.thread_names:
+            # so the spans of the light worker... show under the name of their thread
+            self.thread_names[thread] = threading.current_thread().name
+        self.events.append((name, category, start, end, thread, args))
+
+    def close(self):
+        """Write the last events and close the file."""
+        self._stop.set()
+        self._writer.join()
+        self._flush()
+        if not self.jsonl:
+            self.file.write(self._format_threads() + "\n]\n")
+        self.file.close()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_every):
+            self._flush()
+
+    def _flush(self):
+        events = self.events
+        if not events:
+            return
+
+        lines = []
+        # only what is there now, the main thread keeps appending
+        for _ in range(len(events)):
+            name, category, start, end, thread, args = events.popleft()
+            lines.append(self._format(name, category, start, end, thread, args))
+
+        if self.jsonl:
+            self.file.write("\n".join(lines) + "\n")
+        else:
+            if not self._first:
+                self.file.write(",\n")
+            self.file.write(",\n".join(lines))
+        self._first = False
+        self.file.flush()
+
+    def _format(self, name, category, start, end, thread, args):
+        if self.jsonl:
+            return json.dumps(dict(name=name, cat=category, start=start - self.origin,
+                                   dur=end - start, thread=thread, **args))
+
+        # Chrome wants microseconds
+        return json.dumps(dict(name=name, cat=category, ph="X", pid=os.getpid(), tid=thread,
+                               ts=(start - self.origin) * 1e6, dur=(end - start) * 1e6, args=args))
+
+    def _format_threads(self):
+        """Metadata events so the viewer shows the names of the threads."""
+        events = [json.dumps(dict(name="thread_name", ph="M", pid=os.getpid(), tid=thread, args=dict(name=name)))
+                  for thread, name in self.thread_names.items()]
+        return ("" if self._first else ",\n") + ",\n".join(events)
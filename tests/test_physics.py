@@ -0,0 +1,63 @@
+import pytest
+
+from physics import AABB, Body, Space, TileGrid
+
+
+@pytest.mark.parametrize("thickness", [1, 2, 3])
+def test_fast_elastic_body_bounces_once_on_a_thick_wall(thickness):
+    space = Space()
+    space.add(TileGrid([(x, 0) for x in range(thickness)], 16))
+    body = Body(AABB(60, 2, 8, 8), elasticity=0.5)
+    space.add(body)
+    body.velocity.x = -50
+
+    space.simulate()
+
+    assert body.shape.left == 16 * thickness
+    assert body.velocity.x == 25
+    assert body.collide_left
+
+
+def test_fast_elastic_body_bounces_once_on_a_thick_floor():
+    space = Space()
+    space.add(TileGrid([(0, y) for y in range(2, 5)], 16))
+    body = Body(AABB(2, 0, 8, 8), elasticity=0.5)
+    space.add(body)
+    body.velocity.y = 40
+
+    space.simulate()
+
+    assert body.shape.bottom == 32
+    assert body.velocity.y == -20
+    assert body.collide_down
+
+
+def sleeping_body():
+    space = Space((0, 0.2))
+    space.add(TileGrid([(x, 1) for x in range(4)], 16))
+    body = Body(AABB(20, 8, 8, 8), mass=1)
+    space.add(body)
+    for _ in range(Space.SLEEP_TICKS + 5):
+        space.simulate()
+    assert body.sleeping
+    return space, body
+
+
+def test_removed_sleeping_body_can_be_pushed():
+    space, body = sleeping_body()
+    space.remove(body)
+
+    body.velocity.x = 1
+    body.acceleration.x = 1
+    assert not body.sleeping
+
+
+def test_removed_sleeping_body_is_simulated_when_added_again():
+    space, body = sleeping_body()
+    space.remove(body)
+    space.add(body)
+
+    body.velocity.x = 1
+    space.simulate()
+    assert body in space.awake_bodies
+    assert body.shape.left > 20
@@ -0,0 +1,47 @@
+import os
+import random
+
+import pytest
+
+from tilemap import Tile, TileMap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def covered_cells(tile_map):
+    """The map positions covered by the collision rectangles, checking they don't overlap."""
+    size = tile_map.tile_size
+    cells = set()
+    for rect in tile_map.collision_rects():
+        for x in range(round(rect.left) // size, round(rect.right) // size):
+            for y in range(round(rect.top) // size, round(rect.bottom) // size):
+                assert (x, y) not in cells, f"{(x, y)} is covered twice"
+                cells.add((x, y))
+    return cells
+
+
+def random_map(seed, fill):
+    rng = random.Random(seed)
+    tiles = [Tile("dirt", 16), Tile("glass", 16, solid=False)]
+    positions = {(x, y): rng.choice((0, 0, 1))
+                 for x in range(-10, 30) for y in range(-5, 20) if rng.random() < fill}
+    return TileMap(tiles, positions, 16)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("fill", [0.1, 0.5, 0.9])
+def test_collision_rects_cover_the_solid_tiles(seed, fill):
+    tile_map = random_map(seed, fill)
+    assert covered_cells(tile_map) == set(tile_map.solid_positions())
+
+
+def test_collision_rects_of_the_level():
+    tile_map = TileMap.load(os.path.join(ROOT, "assets/levels/0"))
+    rects = tile_map.collision_rects()
+    assert covered_cells(tile_map) == set(tile_map.solid_positions())
+    # the merging is worth it
+    assert len(rects) < len(tile_map.solid_positions())
+
+
+def test_collision_rects_of_an_empty_map():
+    assert TileMap().collision_rects() == []
@@ -0,0 +1,402 @@
+"""
+The tiles and the tile maps, shared by the game and the map editor (apple.py).
+"""
+
+import json
+import os
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List
+
+import numpy as np
+import pygame
+
+import level
+from assets import assets
+from physics import AABB, Pos, TileGrid
+
+
+class Tile:
+    solid: bool
+    transparent: bool
+    name: str
+    file_path: str
+    sprite_sheet: pygame.Surface
+    neighbours_patterns: list
+    tile_size: int
+
+    def __init__(self, path, tile_size=0, solid=True, transparent=False):
+        self.solid = solid
+        self.transparent = transparent
+        self.file_path = path
+        self.tile_size = tile_size
+        self.name = os.path.basename(path)
+        self.neighbours_patterns = self.load_neighbourg_data(path + ".data")
+        # scale -> sprite sheet at this scale, acquired from the asset cache
+        self._sheets = {}  # type: Dict[int, pygame.Surface]
+
+    @property
+    def sprite_sheet(self):
+        return self.get_sprite_sheet(1)
+
+    def get_sprite_sheet(self, scale):
+        # The sheet is acquired only when we first draw the tile,
+        # so loading a map (or using it only for collisions) stays cheap,
+        # and it is decoded only once for all the maps that use it
+        if scale not in self._sheets:
+            self._sheets[scale] = assets.acquire(self.file_path, scale, colorkey=(255, 0, 255))
+        return self._sheets[scale]
+
+    def release(self):
+        """Give the sprite sheets back to the asset cache."""
+        for scale in self._sheets:
+            assets.release(self.file_path, scale, colorkey=(255, 0, 255))
+        self._sheets.clear()
+
+    def load_neighbourg_data(self, path):
+        return [
+            ["? ? ==?=?", "? ?======", "? ?== ?=?", "? ? = ?=?", "===?==?= ", "=====? =?"],
+            ["?=? ==?=?", "=========", "?=?== ?=?", "?=? = ?=?", "?= ?=====", " =?==?==="],
+            ["?=? ==? ?", "?=?===? ?", "?=?== ? ?", "?=? = ? ?", "? ? ==?= ", "? ?==  =?"],
+            ["? ? ==? ?", "? ?===? ?", "? ?== ? ?", "? ? = ? ?", "?=  ==? ?", " =?== ? ?"]
+        ]
+
+    def get_tile_from_sheet(self, pos, scale=1):
+        size = self.tile_size * scale
+        return self.get_sprite_sheet(scale).subsurface((pos[0] * size, pos[1] * size, size, size))
+
+    def get_image(self, neighbours=(), scale=1):
+        pos = (1, 1)
+
+        if neighbours:
+            tile_name = neighbours[0][0]
+            for Y, line in enumerate(self.neighbours_patterns):
+                for X, pattern in enumerate(line):
+                    match = True
+                    for x in range(3):
+                        for y in range(3):
+                            c = pattern[3 * y + x]
+                            if c == '=':
+                                if neighbours[x - 1][y - 1] != tile_name:
+                                    match = False
+                            elif c == ' ':
+                                if neighbours[x - 1][y - 1] == tile_name:
+                                    match = False
+                            elif c == '?':
+                                # any tile will do
+                                pass
+
+                    if match:
+                        pos = X, Y
+
+        # the whole sheet is scaled once, a tile is only a part of it
+        return self.get_tile_from_sheet(pos, scale)
+
+
+class TileMap:
+    tiles: Dict[tuple, int]
+    tile_objects: List[Tile]
+    tile_size: int
+
+    def __init__(self, tile_objects=None, tiles=None, tile_size=16):
+        self.scale = 4
+        self.render_topleft = (0, 0)
+        self.tile_size = tile_size
+        self.tiles = tiles if tiles is not None else {}
+        self.tile_objects = tile_objects if tile_objects is not None else []
+        # light blocking runs, by line ('h', y) or ('v', x) -> [(start, end, sign), ...]
+        self._blockers = None
+
+    def world_pos_to_map(self, world_pos):
+        return (world_pos[0] // self.tile_size, world_pos[1] // self.tile_size)
+
+    def map_to_world_pos(self, map_pos):
+        return (map_pos[0] * self.tile_size, map_pos[1] * self.tile_size)
+
+    def tile_at_map_pos(self, map_pos):
+        if map_pos in self.tiles:
+            tile_id = self.tiles[map_pos]
+            return self.tile_objects[tile_id]
+
+        return None
+
+    def tile_at_world_pos(self, world_pos):
+        world_pos = self.world_pos_to_map(world_pos)
+        return self.tile_at_map_pos(world_pos)
+
+    def map_to_display_pos(self, map_pos):
+        return Pos(self.map_to_world_pos(map_pos)) * self.scale + self.render_topleft
+
+    def display_to_map_pos(self, display_pos):
+        return self.world_pos_to_map((Pos(display_pos) - self.render_topleft) // self.scale)
+
+
+    def save(self, file='assets/levels/0', binary=False):
+        tile_paths = [tile.file_path for tile in self.tile_objects]
+
+        if binary:
+            level.write_level(file, self.tiles, tile_paths, self.tile_size)
+            return
+
+        tile_map = {}
+        for pos, tile_id in self.tiles.items():
+            tile_map[f'{pos[0]} {pos[1]}'] = tile_id
+
+        to_save = dict(tile_paths=tile_paths,
+                       tile_map=tile_map,
+                       tile_size=self.tile_size)
+        s = json.dumps(to_save)
+        with open(file, 'w') as f:
+            f.write(s)
+
+    @classmethod
+    def load(cls, file='assets/levels/0', region=None):
+        """
+        Load a map saved either in JSON or in the binary format (see level.py).
+
+        :param region: (x, y, w, h) in map coordinates, to load only a part of a binary level.
+        """
+
+        if level.is_binary_level(file):
+            header, grid = level.read_grid(file, region)
+            origin = header.origin if region is None else region[:2]
+            tiles = level.grid_to_tiles(grid, origin)
+            tile_paths = header.tile_paths
+            tile_size = header.tile_size
+        else:
+            if region is not None:
+                raise ValueError("Only binary levels can be partially loaded.")
+            tiles, tile_paths, tile_size = level.read_json_level(file)
+
+        tile_objects = [Tile(path, tile_size) for path in tile_paths]
+
+        return cls(tile_objects, tiles, tile_size)
+
+    def get_neighbours_name(self, map_pos):
+        """Get a table with the neighbors. topleft will be table[-1][-1] and center right will be table[1][0]."""
+        neigh = [[None] * 3 for _ in range(3)]
+
+        for x in range(-1, 2):
+            for y in range(-1, 2):
+                neighbor = map_pos[0] + x, map_pos[1] + y
+                tile = self.tile_at_map_pos(neighbor)
+                if tile is not None:
+                    tile = tile.name
+                neigh[x][y] = tile
+
+        return tuple(tuple(line) for line in neigh)
+
+    @lru_cache(maxsize=None)
+    def get_image_at(self, map_pos, scale):
+        tile = self.tile_at_map_pos(map_pos)
+        return tile.get_image(self.get_neighbours_name(map_pos), scale)
+
+    def solid_positions(self):
+        """Map positions of all the solid tiles."""
+        return [pos for pos, tile_id in self.tiles.items() if self.tile_objects[tile_id].solid]
+
+    def collider(self):
+        """A static collider for the physics, made directly of the solid tiles."""
+        return TileGrid(self.solid_positions(), self.tile_size)
+
+    def collision_rects(self):
+        """
+        Cover the solid tiles with as few rectangles as we reasonably can.
+
+        Each line is first cut in horizontal runs, then runs with the same
+        x-extent on consecutive lines are merged together downwards.
+        """
+
+        # we sort them by Y then X
+        positions = sorted((pos[1], pos[0]) for pos in self.solid_positions())
+
+        # horizontal runs of each line, as (y, x_start, x_end)
+        runs = []
+        for y, x in positions:
+            if runs and runs[-1][0] == y and runs[-1][2] == x:
+                # just after on the same line : we expand the block
+                runs[-1][2] = x + 1
+            else:
+                runs.append([y, x, x + 1])
+
+        # runs that can still grow downwards, by x-extent -> [y_start, y_end]
+        growing = {}
+        blocks = []
+        for y, x_start, x_end in runs:
+            block = growing.get((x_start, x_end))
+            if block is not None and block[1] == y:
+                block[1] = y + 1
+            else:
+                if block is not None:
+                    blocks.append((x_start, x_end, *block))
+                growing[(x_start, x_end)] = [y, y + 1]
+        blocks.extend((x_start, x_end, *block) for (x_start, x_end), block in growing.items())
+
+        # assuming a constant tile size
+        tile_size = self.tile_size
+        return [AABB(x_start * tile_size, y_start * tile_size,
+                     (x_end - x_start) * tile_size, (y_end - y_start) * tile_size)
+                for x_start, x_end, y_start, y_end in blocks]
+
+    def is_opaque(self, map_pos):
+        tile = self.tile_at_map_pos(map_pos)
+        return tile is not None and not tile.transparent
+
+    def light_blockers(self):
+        """
+        Segments, in world coordinates, between opaque and non opaque tiles.
+
+        Aligned edges are merged together, as long as the opaque side stays the same,
+        so two blocks touching by a corner never get a segment crossing the other.
+        The result is cached and kept up to date by add_tile and remove_tile.
+        """
+
+        if self._blockers is None:
+            self._blockers = self._compute_blocker_runs()
+
+        return [self._run_to_segment(line, run) for line, runs in self._blockers.items() for run in runs]
+
+    def _compute_blocker_runs(self):
+        """Find all the blocking runs in linear time, by diffing the opaque mask along each axis."""
+
+        opaque = [pos for pos in self.tiles if self.is_opaque(pos)]
+        runs = defaultdict(list)
+        if not opaque:
+            return runs
+
+        pos = np.array(opaque)
+        # we pad the mask by one tile on each side so edges are never on the border
+        ox, oy = pos.min(axis=0) - 1
+        w, h = pos.max(axis=0) - (ox, oy) + 2
+        mask = np.zeros((h, w), dtype=np.int8)
+        mask[pos[:, 1] - oy, pos[:, 0] - ox] = 1
+
+        # The sign of the diff tells on which side the opaque tile is.
+        # horizontal edges: between mask[r] and mask[r + 1], on the line y = oy + r + 1
+        for r, c, end, sign in self._runs(mask[:-1] - mask[1:]):
+            runs['h', oy + r + 1].append((ox + c, ox + end, sign))
+        # vertical edges: between mask[:, c] and mask[:, c + 1], on the line x = ox + c + 1
+        for c, r, end, sign in self._runs((mask[:, :-1] - mask[:, 1:]).T):
+            runs['v', ox + c + 1].append((oy + r, oy + end, sign))
+
+        return runs
+
+    @staticmethod
+    def _runs(diff):
+        """
+        Yield the (line, start, end, sign) of each run of constant non zero sign on each line.
+
+        Lines need to start and end with a 0, so runs never continue on the next line.
+        """
+
+        flat = diff.ravel()
+        starts = np.flatnonzero(np.diff(flat)) + 1
+        ends = np.append(starts[1:], len(flat))
+        signs = flat[starts]
+        keep = signs != 0
+
+        width = diff.shape[1]
+        for start, end, sign in zip(starts[keep].tolist(), ends[keep].tolist(), signs[keep].tolist()):
+            line, start = divmod(start, width)
+            yield line, start, end - line * width, sign
+
+    def _edge_sign(self, line, i):
+        """Which side of the i-th edge of the line is opaque: 1 before, -1 after, 0 both or none."""
+        axis, k = line
+        if axis == 'h':
+            return self.is_opaque((i, k - 1)) - self.is_opaque((i, k))
+        return self.is_opaque((k - 1, i)) - self.is_opaque((k, i))
+
+    def _run_to_segment(self, line, run):
+        axis, k = line
+        start, end, _ = run
+        p = self.tile_size
+        if axis == 'h':
+            return (start * p, k * p), (end * p, k * p)
+        return (k * p, start * p), (k * p, end * p)
+
+    def update_light_blockers(self, map_pos):
+        """
+        Update the light blockers after the tile at map_pos changed.
+
+        Only the four lines around the tile are looked at, and on those, only
+        the runs touching the tile, so this is proportional to the length of those runs.
+
+        :return: the segments that were added and the ones that were removed
+        """
+
+        if self._blockers is None:
+            blockers = self.light_blockers()
+            return blockers, []
+
+        x, y = map_pos
+        added = []
+        removed = []
+        for line, i in ((('h', y), x), (('h', y + 1), x), (('v', x), y), (('v', x + 1), y)):
+            runs = self._blockers[line]
+            # runs touching the edge may change or merge with it
+            old = [run for run in runs if run[0] <= i + 1 and run[1] >= i]
+            start = min([i] + [run[0] for run in old])
+            end = max([i + 1] + [run[1] for run in old])
+
+            new = []
+            for j in range(start, end):
+                sign = self._edge_sign(line, j)
+                if new and new[-1][1] == j and new[-1][2] == sign:
+                    new[-1] = new[-1][0], j + 1, sign
+                elif sign:
+                    new.append((j, j + 1, sign))
+
+            for run in old:
+                if run not in new:
+                    runs.remove(run)
+                    removed.append(self._run_to_segment(line, run))
+            for run in new:
+                if run not in old:
+                    runs.append(run)
+                    added.append(self._run_to_segment(line, run))
+
+        return added, removed
+
+    def add_new_tile_type(self, path, *args, **kwargs):
+        tile = Tile(path, *args, **kwargs)
+        tile.tile_size = self.tile_size
+        self.tile_objects.append(tile)
+
+    def add_tile(self, pos, tile_id):
+        """Put a tile at pos. If the light blockers are computed, return the segments (added, removed)."""
+        self.get_image_at.cache_clear()
+        self.tiles[pos] = tile_id
+        if self._blockers is not None:
+            return self.update_light_blockers(pos)
+
+    def remove_tile(self, pos):
+        """Remove the tile at pos. If the light blockers are computed, return the segments (added, removed)."""
+        self.get_image_at.cache_clear()
+        self.tiles.pop(pos, None)
+        if self._blockers is not None:
+            return self.update_light_blockers(pos)
+
+    def clear(self):
+        self.get_image_at.cache_clear()
+        self.tiles.clear()
+        self._blockers = None
+
+    def unload(self):
+        """Release the images of the tiles, before switching to another map."""
+        self.get_image_at.cache_clear()
+        for tile in self.tile_objects:
+            tile.release()
+
+    def preload(self):
+        """Decode the sprite sheets in the background, before the map is first drawn."""
+        return assets.preload([tile.file_path for tile in self.tile_objects])
+
+    def render(self, surf, scale=1, offset=(0, 0)):
+        for pos, tile_id in self.tiles.items():
+            tile = self.tile_objects[tile_id]
+            if tile.transparent:
+                continue
+            img = self.get_image_at(pos, scale)
+            topleft = Pos(self.map_to_world_pos(pos)) * scale + offset + self.render_topleft
+            surf.blit(img, topleft)